@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from flammerouge import *
+
+# Benchmarks
+# ==========
+# Times the deck engine, post generation and the Flask routes with fixed
+# seeds, so runs on different commits do the same work. Results are written
+# as JSON and can be compared with an earlier run:
+#
+#   python bench.py -o before.json
+#   python bench.py -o after.json --compare before.json
+
+SEED = 1234
+# Determines how long each benchmark is repeated for, in seconds
+MIN_TIME = 0.2
+REPEATS = 5
+
+TEAM_COUNTS = (2, 4, 8, 12)
+EXHAUSTION_COUNTS = (0, 10, 50, 200)
+# A change in time per op larger than this is reported as a regression
+THRESHOLD = 0.10
+
+BENCHMARKS = []
+
+def benchmark(name):
+    """Register a benchmark, a generator of (case, setup, run(state)) tuples."""
+    def register(f):
+        BENCHMARKS.append((name, f))
+        return f
+    return register
+
+def measure(setup, run, min_time=MIN_TIME, repeats=REPEATS):
+    """Return the best time per run in seconds, excluding setup."""
+    best = None
+    for repeat in range(repeats):
+        elapsed, count = 0.0, 0
+        while elapsed < min_time / repeats or count == 0:
+            state = setup()
+            start = time.perf_counter()
+            run(state)
+            elapsed += time.perf_counter() - start
+            count += 1
+        per_run = elapsed / count
+        if best is None or per_run < best:
+            best = per_run
+    return best
+
+def make_stage(teams, name="Bench"):
+    stage = Stage(name)
+    for i in range(teams):
+        stage.add_team("Team{0:02d}".format(i), "Player{0}".format(i), "#{0:06X}".format(i * 0x151515))
+    return stage
+
+def make_rider(exhaustion):
+    rider = Rider("Rouleur", "R", [3,3,3,4,4,4,5,5,5,6,6,6,7,7,7])
+    for i in range(exhaustion):
+        rider.add_exhaustion()
+    return rider
+
+def play_best(rider):
+    if len(rider.drawn_cards) > 0:
+        rider.play_card(card_name(max(rider.drawn_cards, key=card_value)))
+
+def play_turn(stage):
+    for rider in stage.riders().values():
+        play_best(rider)
+
+# Deck engine
+
+@benchmark("decklist.draw_play")
+def bench_draw_play():
+    # 20 turns of drawing and playing as exhaustion builds up
+    for exhaustion in EXHAUSTION_COUNTS:
+        def setup(exhaustion=exhaustion):
+            random.seed(SEED)
+            return make_rider(exhaustion)
+        def run(rider):
+            for turn in range(20):
+                rider.draw_cards()
+                play_best(rider)
+        yield "exhaustion={0}".format(exhaustion), setup, run
+
+@benchmark("decklist.end_of_stage")
+def bench_end_of_stage():
+    for exhaustion in EXHAUSTION_COUNTS:
+        def setup(exhaustion=exhaustion):
+            random.seed(SEED)
+            rider = make_rider(exhaustion)
+            for turn in range(5):
+                rider.draw_cards()
+                play_best(rider)
+            return rider
+        yield "exhaustion={0}".format(exhaustion), setup, lambda rider: rider.perform_end_of_stage_actions()
+
+# Post generation
+
+def _phase_stage(teams):
+    random.seed(SEED)
+    stage = make_stage(teams)
+    for team in stage.team_dict.values():
+        team.riders["R"].in_breakaway = True
+    stage.perform_breakaway_energy_phase()
+    play_turn(stage)
+    stage.perform_energy_phase()
+    play_turn(stage)
+    return stage
+
+@benchmark("stage.output")
+def bench_output():
+    for teams in TEAM_COUNTS:
+        stage = _phase_stage(teams)
+        for output in ("output_breakaway_energy_phase", "output_breakaway_bid_phase",
+                       "output_energy_phase", "output_movement_phase"):
+            yield "{0} teams={1}".format(output, teams), lambda: stage, getattr(Stage, output)
+
+@benchmark("stage.full")
+def bench_full_stage():
+    # 15 turns of energy phases, plays and posts, then the next Stage
+    for teams in TEAM_COUNTS:
+        def setup(teams=teams):
+            random.seed(SEED)
+            return make_stage(teams)
+        def run(stage):
+            for turn in range(15):
+                stage.perform_energy_phase()
+                stage.output_energy_phase()
+                play_turn(stage)
+                stage.output_movement_phase()
+            Stage("Next").from_stage(stage)
+        yield "teams={0}".format(teams), setup, run
+
+@benchmark("stage.action")
+def bench_action():
+    # A single Rider action and the phase checks made after it, which should
+    # cost the same however many Teams there are
+    for teams in TEAM_COUNTS:
+        def setup(teams=teams):
+            random.seed(SEED)
+            stage = make_stage(teams)
+            stage.perform_energy_phase()
+            return stage
+        def run(stage):
+            team_name = stage.teams()[-1].name
+            rider = stage.get_rider(team_name, "R")
+            stage.play_card(team_name, "R", card_name(rider.drawn_cards[0]))
+            stage.add_exhaustion(team_name, "R")
+            stage.all_riders_have_played_cards()
+            stage.team_has_nominated_rider(team_name)
+        yield "teams={0}".format(teams), setup, run
+
+# Flask routes
+
+@benchmark("routes")
+def bench_routes():
+    os.environ.setdefault("SUDO_UID", str(os.getuid()))
+    os.environ.setdefault("SUDO_GID", str(os.getgid()))
+    import index
+    stages_dir = tempfile.mkdtemp()
+    index.stages_dir = stages_dir + "/"
+    client = index.app.test_client()
+    try:
+        for teams in (2, 6, index.MAX_TEAMS):
+            random.seed(SEED)
+            name = "Bench{0}".format(teams)
+            form = {"stage_name": name}
+            for i in range(1, index.MAX_TEAMS + 1):
+                form["team_name_{0}".format(i)] = "Team{0}".format(i) if i <= teams else ""
+                form["team_colour_{0}".format(i)] = "#CD4C32"
+                form["team_player_{0}".format(i)] = "Player{0}".format(i)
+            client.post("/create_stage", data=form)
+            base = "/stage/{0}".format(name)
+            client.get(base + "/energy")
+            session = index.stage_registry.get(name)
+            stage = session.stage
+
+            def play_url():
+                # Play the first card of the first Rider with a hand
+                for (team_name, short), rider in stage.riders().items():
+                    if len(rider.drawn_cards) > 0:
+                        return "{0}/play/{1}/{2}/{3}".format(base, team_name, short, card_name(rider.drawn_cards[0]))
+                client.get(base + "/energy")
+                return play_url()
+
+            label = "teams={0}".format(teams)
+            yield "render_stage " + label, lambda: None, lambda state: client.get(base + "/")
+            yield "update " + label, lambda: None, lambda state: client.get(base + "/determine_turn_order", query_string={"v": stage.version, "s": session.id})
+            yield "play " + label, play_url, lambda url: client.get(url)
+            yield "energy " + label, lambda: None, lambda state: client.get(base + "/energy")
+            yield "stage_list " + label, lambda: None, lambda state: client.get("/view_stage_list")
+    finally:
+        shutil.rmtree(stages_dir)
+
+def run_benchmarks(selected=None, min_time=MIN_TIME):
+    results = {}
+    for name, cases in BENCHMARKS:
+        if selected and not any(name.startswith(s) for s in selected):
+            continue
+        for case, setup, run in cases():
+            key = "{0} {1}".format(name, case)
+            results[key] = measure(setup, run, min_time)
+            print("{0:<55} {1:>10.1f} us".format(key, results[key] * 1e6))
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """Print the change in every benchmark against a previous run."""
+    regressions = 0
+    print("\nCompared with {0}:".format(previous.get("revision")))
+    for key, seconds in sorted(results.items()):
+        before = previous["results"].get(key)
+        if before is None:
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > THRESHOLD:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{0:<55} {1:>+8.1%}{2}".format(key, change, flag))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FlammeRougePBF")
+    parser.add_argument("benchmarks", nargs="*", help="only run benchmarks starting with these names")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="seconds spent on each benchmark")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, args.min_time)
+    data = {"revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "seed": SEED,
+            "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)) > 0:
+                sys.exit(1)
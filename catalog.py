@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Stage catalog
+# =============
+# Index of every stored Stage state, so listings don't have to walk and stat
+# the stages directory. Kept up to date as states are stored, and rebuilt
+# from the stages directory if the catalog is missing.
+
+CATALOG_FILENAME = "catalog.db"
+
+# Determines how many Stages are listed per page
+PAGE_SIZE = 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    name     TEXT PRIMARY KEY,
+    created  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    stage    TEXT NOT NULL,
+    label    TEXT NOT NULL,
+    turn     INTEGER,
+    bid      INTEGER,
+    created  REAL NOT NULL,
+    size     INTEGER,
+    PRIMARY KEY (stage, label)
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_time ON snapshots (stage, created DESC);
+"""
+
+class StageCatalog:
+    def __init__(self, path):
+        self.path = path
+        self.is_new = not os.path.isfile(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def _write(self, *statements):
+        with self._lock:
+            with self._db:
+                for sql, args in statements:
+                    self._db.execute(sql, args)
+
+    def _read(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def add_stage(self, name, created=None):
+        """Record a new Stage, forgetting any states stored under its name."""
+        if created is None:
+            created = time.time()
+        self._write(("INSERT OR REPLACE INTO stages (name, created) VALUES (?, ?)", (name, created)),
+                    ("DELETE FROM snapshots WHERE stage = ?", (name,)))
+
+    def add_snapshot(self, stage_name, label, turn=None, bid=None, size=None, created=None):
+        """Record a stored state, replacing any earlier state with its label."""
+        if created is None:
+            created = time.time()
+        self._write(("INSERT OR IGNORE INTO stages (name, created) VALUES (?, ?)", (stage_name, created)),
+                    ("INSERT OR REPLACE INTO snapshots (stage, label, turn, bid, created, size) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (stage_name, label, turn, bid, created, size)))
+
+    def stages(self, page=0, page_size=None):
+        """Return Stage names in reverse name order, a page at a time."""
+        return [row[0] for row in self._read(
+            "SELECT name FROM stages ORDER BY name DESC LIMIT ? OFFSET ?",
+            self._limit(page, page_size))]
+
+    def stage_count(self):
+        return self._read("SELECT COUNT(*) FROM stages", ())[0][0]
+
+    def snapshots(self, stage_name, page=0, page_size=None):
+        """Return (label, turn, bid, created, size) for a Stage, newest first."""
+        return self._read(
+            "SELECT label, turn, bid, created, size FROM snapshots WHERE stage = ? "
+            "ORDER BY created DESC LIMIT ? OFFSET ?",
+            (stage_name,) + self._limit(page, page_size))
+
+    def _limit(self, page, page_size):
+        if page_size is None:
+            return (-1, 0)
+        return (page_size, page * page_size)
+
+    def rebuild(self, stages_dir, scan):
+        """Rebuild the catalog from the stages directory.
+
+        scan(stage_name) returns (label, created, size, turn, bid) for each
+        stored state."""
+        statements = [("DELETE FROM snapshots", ()), ("DELETE FROM stages", ())]
+        for name in os.listdir(stages_dir):
+            directory = os.path.join(stages_dir, name)
+            if not os.path.isdir(directory):
+                continue
+            statements.append(("INSERT INTO stages (name, created) VALUES (?, ?)",
+                               (name, os.path.getctime(directory))))
+            for label, created, size, turn, bid in scan(name):
+                statements.append(("INSERT OR REPLACE INTO snapshots (stage, label, turn, bid, created, size) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)", (name, label, turn, bid, created, size)))
+        self._write(*statements)
@@ -0,0 +1,224 @@
+import argparse
+import csv
+import json
+import os
+from flammerouge import EXHAUSTION, SHUFFLED_MESSAGE
+from stagefile import load_stage
+from stagelog import LOG_FILENAME, StageLog, apply_action, create_stage
+
+# Season export
+# =============
+# Flat tables of every stored Stage state, for statistics across a season:
+#
+#   stages - one row per state: turn, bid, shuffles so far, Riders finished
+#   riders - one row per Rider per state: cards played, exhaustion cards held,
+#            reshuffles so far and how the Rider's last breakaway ended
+#
+# A state is a label of a Stage, as listed on the load page. Stages are read
+# one at a time: logged Stages are replayed record by record and stored
+# Stage files are loaded one by one, so only one state is in memory at once.
+#
+# Exports are incremental. The output directory keeps what has been exported
+# (the size of each log, and the time and size of each Stage file), so
+# running the export again only adds rows for states stored since. A state
+# still being played is exported again whenever it changes, as is every
+# state of a Stage created again with the same name, so keep the last row for
+# each (stage, label), or (stage, label, team, rider):
+#
+#   python export.py <stages directory> <output directory> [--format jsonl]
+
+STATE_FILENAME = "export-{0}.json"
+STAGES_TABLE = "stages"
+RIDERS_TABLE = "riders"
+
+STAGE_COLUMNS = ("stage", "label", "turn", "bid", "breakaway_started", "track", "shuffles",
+                 "riders", "finished_riders")
+RIDER_COLUMNS = ("stage", "label", "turn", "bid", "team", "player", "bot", "rider", "name",
+                 "cards_played", "exhaustion", "deck", "in_breakaway", "finished", "reshuffles",
+                 "breakaway")
+
+class _CSVTable:
+    def __init__(self, path, columns):
+        new = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='', encoding='utf-8')
+        # Rows are built with exactly the columns, so skip checking them
+        self._writer = csv.DictWriter(self._file, columns, extrasaction="ignore")
+        if new:
+            self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+class _JSONLinesTable:
+    def __init__(self, path, columns):
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, row):
+        self._file.write(json.dumps(row, separators=(',', ':')) + "\n")
+
+    def close(self):
+        self._file.close()
+
+# Table writers by format, which is also the file extension
+TABLE_FORMATS = {
+    "csv": _CSVTable,
+    "jsonl": _JSONLinesTable,
+    }
+
+class _Tally:
+    # What a Stage's states don't hold themselves, counted while replaying
+    def __init__(self):
+        self.reshuffles = {}
+        self.breakaway = {}
+        self.records = 0
+
+    def count_reshuffles(self, stage, action):
+        # Only the Riders which drew in the phase have a new message
+        for key, rider in stage.riders().items():
+            drew = rider.in_breakaway if action == "breakaway_energy" else not rider.finished_stage
+            if drew and rider.message == SHUFFLED_MESSAGE:
+                self.reshuffles[key] = self.reshuffles.get(key, 0) + 1
+
+def _replay(stage, record, directory, tally):
+    # Apply a log record, returning the Stage after it
+    action, args = record[1], record[2:]
+    if action == "create":
+        return create_stage(args[0])
+    if action == "snapshot":
+        return load_stage(os.path.join(directory, args[0]))
+    if action in ("undo", "redo"):
+        step = stage.undo() if action == "undo" else stage.redo()
+        if step is not None and step[0] in ("winner", "loser"):
+            key = tuple(step[1][0])
+            if action == "undo":
+                tally.breakaway.pop(key, None)
+            else:
+                tally.breakaway[key] = step[0]
+        return stage
+    apply_action(stage, action, args)
+    if action in ("energy", "breakaway_energy"):
+        tally.count_reshuffles(stage, action)
+    elif action in ("winner", "loser"):
+        tally.breakaway[tuple(args[:2])] = action
+    return stage
+
+def _log_states(directory, start):
+    # Yield (label, Stage, Tally) at the end of every run of records with the
+    # same label, for runs ending at or after record start
+    stage, tally = None, _Tally()
+    records = StageLog(directory).records()
+    record = next(records, None)
+    while record is not None:
+        stage = _replay(stage, record, directory, tally)
+        following = next(records, None)
+        if tally.records >= start and (following is None or following[0] != record[0]):
+            yield record[0], stage, tally
+        record = following
+        tally.records += 1
+
+def stage_states(stages_dir, exported):
+    """Yield (stage name, label, Stage, Tally) for every state not yet exported.
+
+    exported is the export state, which is updated as each Stage is read."""
+    for name in sorted(os.listdir(stages_dir)):
+        directory = os.path.join(stages_dir, name)
+        if not os.path.isdir(directory):
+            continue
+        done = exported.setdefault(name, {})
+        log_path = os.path.join(directory, LOG_FILENAME)
+        if os.path.isfile(log_path):
+            size = os.path.getsize(log_path)
+            with open(log_path, 'r') as f:
+                first = f.readline()
+            if size == done.get("size") and first == done.get("first"):
+                continue
+            # A different first record is a Stage created again with the same name
+            start = done.get("records", 0) if first == done.get("first") else 0
+            tally = None
+            for label, stage, tally in _log_states(directory, start):
+                yield name, label, stage, tally
+            exported[name] = {"size": size, "first": first,
+                              "records": tally.records if tally is not None else start}
+        else:
+            files = done.setdefault("files", {})
+            paths = [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith(".stage")]
+            for path in sorted(paths, key=os.path.getmtime):
+                file = os.path.basename(path)
+                stat = [os.path.getmtime(path), os.path.getsize(path)]
+                if files.get(file) != stat:
+                    # Reshuffles and breakaways are only known from a log
+                    yield name, os.path.splitext(file)[0], load_stage(path), None
+                    files[file] = stat
+
+def state_rows(name, label, stage, tally):
+    """Return the stages row and the riders rows of a Stage state."""
+    riders = stage.riders()
+    stage_row = {"stage": name, "label": label, "turn": stage.turn_number, "bid": stage.bid_number,
+                 "breakaway_started": stage.breakaway_started, "track": stage.track,
+                 "shuffles": stage.rng.shuffles, "riders": len(riders),
+                 "finished_riders": len(stage.finished_riders())}
+    rider_rows = []
+    for key, rider in riders.items():
+        team = stage.get_team(key[0])
+        piles = (rider.energy_pile, rider.recycle_pile, rider.discard_pile, rider.drawn_cards)
+        rider_rows.append({"stage": name, "label": label, "turn": stage.turn_number, "bid": stage.bid_number,
+                           "team": team.name, "player": team.player, "bot": team.bot,
+                           "rider": key[1], "name": rider.name,
+                           "cards_played": len(rider.discard_pile),
+                           "exhaustion": sum(pile.count(EXHAUSTION) for pile in piles),
+                           "deck": len(rider.energy_pile) + len(rider.recycle_pile),
+                           "in_breakaway": rider.in_breakaway, "finished": rider.finished_stage,
+                           "reshuffles": tally.reshuffles.get(key, 0) if tally is not None else None,
+                           "breakaway": tally.breakaway.get(key) if tally is not None else None})
+    return stage_row, rider_rows
+
+def export(stages_dir, output_dir, format="csv", full=False):
+    """Export every Stage state stored since the last export.
+
+    Returns the number of states exported."""
+    if format not in TABLE_FORMATS:
+        raise ValueError("Unknown export format '{0}'".format(format))
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, STATE_FILENAME.format(format))
+    table_paths = [os.path.join(output_dir, "{0}.{1}".format(table, format))
+                   for table in (STAGES_TABLE, RIDERS_TABLE)]
+    if full:
+        for path in [state_path] + table_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+    exported = {}
+    if os.path.isfile(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            exported = json.load(f)
+
+    stages = TABLE_FORMATS[format](table_paths[0], STAGE_COLUMNS)
+    riders = TABLE_FORMATS[format](table_paths[1], RIDER_COLUMNS)
+    count = 0
+    try:
+        for name, label, stage, tally in stage_states(stages_dir, exported):
+            stage_row, rider_rows = state_rows(name, label, stage, tally)
+            stages.write(stage_row)
+            for row in rider_rows:
+                riders.write(row)
+            count += 1
+    finally:
+        stages.close()
+        riders.close()
+        # Only record what is in the tables, so an interrupted export resumes
+        temp_path = state_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(exported, f)
+        os.replace(temp_path, state_path)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export every stored Stage state as flat tables")
+    parser.add_argument("stages_dir", help="the stages directory")
+    parser.add_argument("output_dir", help="directory of the tables and export state")
+    parser.add_argument("--format", choices=sorted(TABLE_FORMATS.keys()), default="csv")
+    parser.add_argument("--full", action="store_true", help="export every state again")
+    args = parser.parse_args()
+    print("Exported {0} states".format(export(args.stages_dir, args.output_dir, args.format, args.full)))
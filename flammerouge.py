@@ -1,48 +1,159 @@
 import math
 import os
-import pickle
 import random
-from enum import Enum
+from collections import OrderedDict, deque
+import metrics
+from track import get_track, resolve_turn, start_positions
 
 # Determines whether decks are kept secret in the Energy and Movement Phases
 KEEP_DECK_SECRET = False
 
-class Format(Enum):
-    BBCODE = 1
-    DISCOURSE = 2
-    
-# Determines the phase output format
-FORMAT = Format.DISCOURSE
+# Determines whether best card odds are appended to the Energy Phase
+SHOW_ODDS = False
+
+# Determines whether exact odds of the next draw are appended to the Energy Phase
+SHOW_EXACT_ODDS = False
+
+# Determines whether Stage counters are checked against a full scan (slow)
+CHECK_COUNTERS = False
+
+# Determines the phase output format of new Stages (see formatters.py)
+DEFAULT_FORMAT = "discourse"
+
+# Determines how many Rider actions can be undone
+UNDO_LIMIT = 50
+
+# Rider types by short name, as (name, energy deck). Moves are written as
+# the short name followed by the card (eg. "r4"), so short names are a
+# single letter
+RIDER_TYPES = {
+    "R": ("Rouleur", [3,3,3,4,4,4,5,5,5,6,6,6,7,7,7]),
+    "S": ("Sprinteur", [2,2,2,3,3,3,4,4,4,5,5,5,9,9,9]),
+    }
+
+# Determines the Riders in a Team, by short name
+DEFAULT_RIDERS = ("R", "S")
+
+# Determines how many Teams a Stage can have
+MAX_TEAMS = 12
+
+# Card codes
+# Cards are stored as small integers: regular cards by their value and
+# exhaustion cards as EXHAUSTION, which sorts after every regular card
+EXHAUSTION = 10
+EXHAUSTION_NAME = "e2"
+EXHAUSTION_VALUE = 2
+# Regular cards are worth 2 to 9
+CARD_VALUES = range(2, 10)
+
+def card_code(card):
+    # Convert a card name ("3", "e2") to its code, raising ValueError for
+    # anything else; "10" isn't the exhaustion card
+    if card == EXHAUSTION_NAME:
+        return EXHAUSTION
+    try:
+        value = int(card)
+    except (TypeError, ValueError):
+        value = None
+    if value not in CARD_VALUES or str(value) != str(card):
+        raise ValueError("Unknown card '{0}'".format(card))
+    return value
+
+def card_name(code):
+    # Convert a card code to its name
+    if code == EXHAUSTION:
+        return EXHAUSTION_NAME
+    return str(code)
+
+def card_names(cards):
+    # Convert a pile of card codes to a list of names
+    return [card_name(c) for c in cards]
+
+def card_value(code):
+    # Return the number of spaces a card is worth
+    if code == EXHAUSTION:
+        return EXHAUSTION_VALUE
+    return code
+
+class StageRandom:
+    # Seeded random stream shared by every deck in a Stage. Each shuffle gets
+    # its own generator, seeded by the Stage seed and the number of shuffles
+    # so far, so the whole stream is stored and restored as two numbers.
+    __slots__ = ("seed", "shuffles")
+
+    def __init__(self, seed=None, shuffles=0):
+        if seed is None:
+            seed = random.getrandbits(63)
+        self.seed = seed
+        self.shuffles = shuffles
+
+    def shuffle(self, cards):
+        self.shuffles += 1
+        random.Random("{0}:{1}".format(self.seed, self.shuffles)).shuffle(cards)
+
+    def derived(self, *key):
+        # Return a generator for a one-off use, eg. turn order, which doesn't
+        # move the shuffle stream on
+        return random.Random(":".join(str(k) for k in (self.seed,) + key))
+
+def _shuffled(cards, rng):
+    # Return the provided cards shuffled into a new pile
+    cards = list(cards)
+    rng.shuffle(cards)
+    return tuple(cards)
+
+# Rider message after a draw shuffled the recycle pile
+SHUFFLED_MESSAGE = "(Deck got shuffled)"
+
+# Hands drawn, by how they were drawn, to see how often decks get shuffled
+DRAWS = metrics.Counter("flammerouge_draws_total", "Hands drawn by Riders, including replayed draws", ("draw",))
+
+# Parts of a Decklist reported to its observer when they change
+STATUS = "status"
 
 class Decklist:
-    def __init__(self, cards):
-        self.energy_pile = list(map(str, cards))
-        self.recycle_pile = []
-        self.discard_pile = []
-        self.drawn_cards =  []
+    __slots__ = ("energy_pile", "recycle_pile", "discard_pile", "drawn_cards", "message", "observer", "rng")
+
+    # Piles are tuples, replaced rather than changed, so copies of a Rider
+    # (Stage snapshots and the next Stage) share every pile until it changes.
+    # They are stored as bytes when pickled
+    _piles = ("energy_pile", "recycle_pile", "discard_pile", "drawn_cards")
+
+    def __init__(self, cards, rng=None):
+        self.observer = None
+        # Replaced by the Stage's stream when the Rider joins a Stage
+        self.rng = rng if rng is not None else StageRandom()
+        self.energy_pile = _shuffled(map(card_code, cards), self.rng)
+        self.recycle_pile = ()
+        self.discard_pile = ()
+        self.drawn_cards = ()
         self.message = ""
-        random.shuffle(self.energy_pile)
+
+    def _changed(self, *parts):
+        # Tell the observer (the owning Team) which parts have changed
+        if self.observer is not None:
+            self.observer.rider_changed(self, parts)
         
     def add_exhaustion(self):
         # Add an exhaustion card to the recycle pile
-        self.recycle_pile.append("e2")
+        self.recycle_pile += (EXHAUSTION,)
+        self._changed("recycle_pile")
         
     def _shuffle_recycle(self):
         # Shuffle the recycle pile into the draw pile
-        self.energy_pile = self.recycle_pile
-        self.recycle_pile = []
-        random.shuffle(self.energy_pile)
+        self.energy_pile = _shuffled(self.recycle_pile, self.rng)
+        self.recycle_pile = ()
         
     def shuffle_deck(self, include_discard = True):
         # Shuffle deck (and optionally the discard pile)
+        cards = self.energy_pile + self.recycle_pile + self.drawn_cards
         if include_discard:
-            self.energy_pile += self.recycle_pile + self.drawn_cards + self.discard_pile
-            self.discard_pile = []
-        else:
-            self.energy_pile += self.recycle_pile + self.drawn_cards
-        self.recycle_pile = []
-        self.drawn_cards = []
-        random.shuffle(self.energy_pile)
+            cards += self.discard_pile
+            self.discard_pile = ()
+        self.recycle_pile = ()
+        self.drawn_cards = ()
+        self.energy_pile = _shuffled(cards, self.rng)
+        self._changed(*Decklist._piles)
         
     def draw_cards(self):
         # Prevent drawing cards if hand is not empty
@@ -52,50 +163,60 @@ class Decklist:
         # If energy pile has more than 4 cards, take 4 cards from the top
         # If player has 4 cards (or fewer) remaining return all the cards
         # Else, shuffle the recycle pile and draw
-        self.drawn_cards = []
         self.message = ""
         
         if len(self.energy_pile) >= 4:
-            for i in range(0,4):
-                self.drawn_cards.append(self.energy_pile.pop(0))
+            self.drawn_cards = self.energy_pile[:4]
+            self.energy_pile = self.energy_pile[4:]
+            DRAWS.inc("energy")
         elif len(self.energy_pile) + len(self.recycle_pile) == 0:
             self.message = "(No cards left in deck)"
-            self.drawn_cards = ['e2']
+            self.drawn_cards = (EXHAUSTION,)
+            DRAWS.inc("exhaustion")
         elif len(self.energy_pile) + len(self.recycle_pile) < 4:
             self.message = "(4 or fewer cards left in deck)"
             self.drawn_cards = self.energy_pile + self.recycle_pile
-            self.energy_pile = []
-            self.recycle_pile = []
+            self.energy_pile = ()
+            self.recycle_pile = ()
+            DRAWS.inc("remaining")
         else:
-            self.message = "(Deck got shuffled)"
-            self.drawn_cards = self.energy_pile
+            self.message = SHUFFLED_MESSAGE
+            DRAWS.inc("shuffled")
+            drawn = self.energy_pile
             self._shuffle_recycle()
-            for i in range(0,4-len(self.drawn_cards)):
-                self.drawn_cards.append(self.energy_pile.pop(0))
+            count = 4 - len(drawn)
+            self.drawn_cards = drawn + self.energy_pile[:count]
+            self.energy_pile = self.energy_pile[count:]
+        self._changed(*Decklist._piles, STATUS)
                     
     def perform_end_of_stage_actions(self):
         self.message = ""
+        self._changed(STATUS)
         # Remove any exhaustion cards in the discard pile
-        self.discard_pile = [c for c in self.discard_pile if c != "e2"]
+        self.discard_pile = tuple(c for c in self.discard_pile if c != EXHAUSTION)
         # Move all cards back into the energy_pile
         self.shuffle_deck(True)
         # Remove half of the exhaustion cards
-        self.energy_pile.sort()
-        ex_count = self.energy_pile.count("e2")
+        ex_count = self.energy_pile.count(EXHAUSTION)
         ex_count_end = math.ceil(ex_count / 2.0)
-        for i in range(0, ex_count - ex_count_end):
-            self.energy_pile.remove("e2")
+        cards = [c for c in self.energy_pile if c != EXHAUSTION]
+        cards += [EXHAUSTION] * ex_count_end
         # Shuffle the deck
-        random.shuffle(self.energy_pile)
+        self.energy_pile = _shuffled(cards, self.rng)
         return (ex_count, ex_count_end)
         
     def play_card(self, card_name):
         # Discard the played card and recycle the remaining drawn cards
-        if card_name in self.drawn_cards:
-            self.discard_pile.append(card_name)
-            self.drawn_cards.remove(card_name)
-            self.recycle_pile += self.drawn_cards
-            self.drawn_cards = []
+        try:
+            card = card_code(card_name)
+        except ValueError:
+            return
+        if card in self.drawn_cards:
+            i = self.drawn_cards.index(card)
+            self.discard_pile += (card,)
+            self.recycle_pile += self.drawn_cards[:i] + self.drawn_cards[i+1:]
+            self.drawn_cards = ()
+            self._changed("drawn_cards", "discard_pile", "recycle_pile")
     
     def get_last_cards_played(self):
         # Return the last played cards
@@ -103,18 +224,87 @@ class Decklist:
             
     def get_deck_list(self):
         return sorted(self.energy_pile + self.recycle_pile)
+
+    def copy(self):
+        # Return a copy sharing every pile, outside any Team
+        copy = type(self).__new__(type(self))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                setattr(copy, name, getattr(self, name))
+        copy.observer = None
+        return copy
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                state[name] = getattr(self, name)
+        for name in Decklist._piles:
+            state[name] = bytes(state[name])
+        # Observers and random streams are re-attached by the Stage
+        del state["observer"]
+        del state["rng"]
+        return state
+
+    def __setstate__(self, state):
+        # Accepts both the compact state and the __dict__ of old .stage files,
+        # where piles were lists of card names
+        if isinstance(state, tuple):
+            state = state[1]
+        self.observer = None
+        self.rng = StageRandom()
+        for name, value in state.items():
+            if name in Decklist._piles:
+                if isinstance(value, bytes):
+                    value = tuple(value)
+                else:
+                    value = tuple(map(card_code, value))
+            setattr(self, name, value)
     
     def __str__(self):
-        return "Hand: {0} - Energy: {1} - Recycle: {2} - Discard: {3}\n".format(",".join(self.drawn_cards), ",".join(self.energy_pile), ",".join(self.recycle_pile), ",".join(self.discard_pile))
+        return "Hand: {0} - Energy: {1} - Recycle: {2} - Discard: {3}\n".format(",".join(card_names(self.drawn_cards)), ",".join(card_names(self.energy_pile)), ",".join(card_names(self.recycle_pile)), ",".join(card_names(self.discard_pile)))
     
 class Rider(Decklist):
-    def __init__(self, name, short_name, deck_list):
-        super().__init__(deck_list)
+    __slots__ = ("name", "short_name", "_in_breakaway", "_finished_stage")
+
+    # Everything an action can change, saved and restored by undo
+    _state = Decklist._piles + ("message", "_in_breakaway", "_finished_stage")
+
+    def __init__(self, name, short_name, deck_list, rng=None):
+        super().__init__(deck_list, rng)
         self.name = name
         self.short_name = short_name
-        self.in_breakaway = False
-        self.finished_stage = False
+        self._in_breakaway = False
+        self._finished_stage = False
+
+    @property
+    def in_breakaway(self):
+        return self._in_breakaway
+
+    @in_breakaway.setter
+    def in_breakaway(self, value):
+        self._in_breakaway = value
+        self._changed(STATUS)
+
+    @property
+    def finished_stage(self):
+        return self._finished_stage
+
+    @finished_stage.setter
+    def finished_stage(self, value):
+        self._finished_stage = value
+        self._changed(STATUS)
     
+    def get_state(self):
+        # Return the state of the Rider, sharing its piles
+        return tuple(getattr(self, name) for name in Rider._state)
+
+    def set_state(self, state):
+        # Restore a state returned by get_state
+        for name, value in zip(Rider._state, state):
+            setattr(self, name, value)
+        self._changed(*Decklist._piles, STATUS)
+
     def perform_end_of_stage_actions(self):
         # Reset breakaway flag
         self.in_breakaway = False
@@ -125,14 +315,54 @@ class Rider(Decklist):
     def __str__(self):
         return super().__str__()
         
+def rider_types(shorts):
+    # Return the provided Rider short names (eg. "RS") as a tuple, raising
+    # ValueError for any unknown type
+    shorts = tuple(short.upper() for short in shorts if not short.isspace())
+    for short in shorts:
+        if short not in RIDER_TYPES:
+            raise ValueError("Unknown rider type '{0}'".format(short))
+    if len(set(shorts)) < len(shorts):
+        raise ValueError("A team can only have one rider of each type")
+    return shorts
+
 class Team:
-    def __init__(self, name, player, colour):
+    __slots__ = ("name", "player", "colour", "riders", "bot", "observer")
+
+    def __init__(self, name, player, colour, rng=None, riders=DEFAULT_RIDERS, bot=False):
         self.name = name
         self.player = player
         self.colour = colour
+        # Bot Teams have their moves made by the Stage (see Stage.bot_moves)
+        self.bot = bot
+        self.observer = None
         self.riders = {}
-        self.riders["R"] = Rider("Rouleur", "R", [3,3,3,4,4,4,5,5,5,6,6,6,7,7,7])
-        self.riders["S"] = Rider("Sprinteur", "S", [2,2,2,3,3,3,4,4,4,5,5,5,9,9,9])
+        for short in rider_types(riders):
+            rider_name, deck = RIDER_TYPES[short]
+            self.riders[short] = Rider(rider_name, short, deck, rng)
+        self._attach()
+
+    def _attach(self):
+        # Observe changes to all Riders
+        for rider in self.riders.values():
+            rider.observer = self
+
+    def copy(self):
+        # Return a copy with copies of every Rider, outside any Stage
+        copy = Team.__new__(Team)
+        copy.name = self.name
+        copy.player = self.player
+        copy.colour = self.colour
+        copy.bot = self.bot
+        copy.observer = None
+        copy.riders = {short: rider.copy() for short, rider in self.riders.items()}
+        copy._attach()
+        return copy
+
+    def rider_changed(self, rider, parts):
+        # Pass Rider changes on to the observer (the Stage)
+        if self.observer is not None:
+            self.observer.rider_changed(self, rider, parts)
 
     def play_s(self, play_string):
         # Take a shorthand string and play those cards
@@ -160,45 +390,465 @@ class Team:
             else:
                 display_string += "{0}:\n{1}\n".format(rider.name, rider)
         return display_string
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Team.__slots__ if name != "observer"}
+
+    def __setstate__(self, state):
+        # Accepts the __dict__ of old .stage files
+        if isinstance(state, tuple):
+            state = state[1]
+        self.observer = None
+        self.bot = False
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._attach()
         
 class Stage:
-    def __init__(self, name=""):
+    def __init__(self, name="", seed=None):
         self.name = name
+        # Every shuffle in the Stage comes from this stream, so a Stage can be
+        # replayed exactly from its seed and actions
+        self.rng = StageRandom(seed)
         self.team_dict = {}
         self.turn_number = 0
         self.bid_number = 0
         self.breakaway_started = False;
+        self.format = DEFAULT_FORMAT
+        # Name of the track (see track.py), or None if the host moves the
+        # Riders on a board, and where each Rider is as {(team_name, short): (square, lane)}
+        self.track = None
+        self.positions = {}
+        # The last turn resolved on the track, and how
+        self.resolved_turn = 0
+        self.resolution = None
+        # Rider actions which can be undone and redone, most recent last
+        self.undo_steps = deque(maxlen=UNDO_LIMIT)
+        self.redo_steps = deque(maxlen=UNDO_LIMIT)
+        # Version of the last change to each part of the Stage
+        self.version = 0
+        self.changes = OrderedDict()
+
+        self._attach()
+
+    def __setstate__(self, state):
+        # Accepts Stages stored before changes were tracked
+        self.__dict__.update(state)
+        self.__dict__.setdefault("version", 0)
+        self.__dict__.setdefault("changes", OrderedDict())
+        self.__dict__.setdefault("format", DEFAULT_FORMAT)
+        self.__dict__.setdefault("rng", StageRandom())
+        self.__dict__.setdefault("undo_steps", deque(maxlen=UNDO_LIMIT))
+        self.__dict__.setdefault("redo_steps", deque(maxlen=UNDO_LIMIT))
+        self.__dict__.setdefault("track", None)
+        self.__dict__.setdefault("positions", {})
+        self.__dict__.setdefault("resolved_turn", 0)
+        self.__dict__.setdefault("resolution", None)
+        self._attach()
+
+    def _attach(self):
+        # Observe changes to all Teams, share the random stream, index the
+        # Teams and Riders and count the Riders in each state
+        for team in self.team_dict.values():
+            team.observer = self
+            for rider in team.riders.values():
+                rider.rng = self.rng
+        self._index()
+        self._recount()
+
+    # Indexes
+    # Teams only join a Stage through _attach, so these are rebuilt there and
+    # lookups never scan the Teams
+    def _index(self):
+        self._teams = [team for team_name, team in sorted(self.team_dict.items())]
+        self._riders = OrderedDict()
+        self._players = {}
+        for team in self._teams:
+            for short, rider in sorted(team.riders.items()):
+                self._riders[(team.name, short)] = rider
+            self._players.setdefault(team.player, []).append(team.name)
+
+    def teams(self):
+        # Return every Team, sorted by name
+        return self._teams
+
+    def riders(self):
+        # Return {(team_name, short): Rider} for every Rider, sorted by Team
+        # and short name
+        return self._riders
+
+    def players(self):
+        # Return {player: [team_name]}
+        return self._players
+
+    def finished_riders(self):
+        # Return the (team_name, short) of every finished Rider, sorted
+        return sorted(self._finished_riders)
+
+    def rider_changed(self, team, rider, parts):
+        # Record which parts of a Rider have changed
+        for part in parts:
+            self.touch((team.name, rider.short_name, part))
+        if "drawn_cards" in parts or STATUS in parts:
+            self._count(team.name, rider)
+
+    # Phase counters
+    # Maintained as Riders change so the phase checks don't scan every Rider
+    def _rider_state(self, rider):
+        return (len(rider.drawn_cards) > 0, rider.in_breakaway, rider.finished_stage)
+
+    def _recount(self):
+        # Count the Riders in each state from scratch
+        self._states = {}
+        self._holding = 0
+        self._holding_breakaway = 0
+        self._unfinished = 0
+        self._nominated = 0
+        self._team_nominated = {}
+        self._teams_nominated = 0
+        self._holding_bots = 0
+        self._finished_riders = set()
+        for team_name, team in self.team_dict.items():
+            self._team_nominated[team_name] = 0
+            for short, rider in team.riders.items():
+                self._count(team_name, rider)
+
+    def _count(self, team_name, rider):
+        # Replace the previous state of a Rider in the counters
+        key = (team_name, rider.short_name)
+        state = self._rider_state(rider)
+        if key in self._states:
+            self._add_state(key, self._states[key], -1)
+        self._states[key] = state
+        self._add_state(key, state, 1)
+
+    def _add_state(self, key, state, sign):
+        team_name = key[0]
+        holding, in_breakaway, finished = state
+        self._holding += sign * holding
+        self._holding_breakaway += sign * (holding and in_breakaway)
+        self._unfinished += sign * (not finished)
+        if self.team_dict[team_name].bot:
+            self._holding_bots += sign * holding
+        if finished:
+            if sign > 0:
+                self._finished_riders.add(key)
+            else:
+                self._finished_riders.discard(key)
+        if in_breakaway:
+            nominated = self._team_nominated[team_name]
+            self._team_nominated[team_name] = nominated + sign
+            self._nominated += sign
+            if nominated == 0 or nominated + sign == 0:
+                self._teams_nominated += sign
+
+    def _check_counters(self):
+        # Compare the counters with a full scan of every Rider
+        counters = (self._holding, self._holding_breakaway, self._unfinished,
+                    self._nominated, self._teams_nominated, dict(self._team_nominated),
+                    self._holding_bots, set(self._finished_riders))
+        self._recount()
+        assert counters == (self._holding, self._holding_breakaway, self._unfinished,
+                            self._nominated, self._teams_nominated, self._team_nominated,
+                            self._holding_bots, self._finished_riders), \
+               "Stage counters out of step with Riders"
+
+    def all_riders_have_played_cards(self, breakaway = False):
+        # Riders in the breakaway if specified, otherwise all Riders
+        if CHECK_COUNTERS:
+            self._check_counters()
+        if breakaway:
+            return self._holding_breakaway == 0
+        return self._holding == 0
+
+    def all_teams_have_nominated_rider(self):
+        if CHECK_COUNTERS:
+            self._check_counters()
+        return self._teams_nominated == len(self.team_dict)
+
+    def no_teams_have_nominated_rider(self):
+        if CHECK_COUNTERS:
+            self._check_counters()
+        return self._nominated == 0
+
+    def team_has_nominated_rider(self, team_name):
+        if CHECK_COUNTERS:
+            self._check_counters()
+        return self._team_nominated[team_name] > 0
+
+    def are_unfinished_riders(self):
+        if CHECK_COUNTERS:
+            self._check_counters()
+        return self._unfinished > 0
+
+    def bots_have_cards(self):
+        if CHECK_COUNTERS:
+            self._check_counters()
+        return self._holding_bots > 0
+
+    def touch(self, key):
+        # Record a change to the provided part of the Stage
+        self.version += 1
+        self.changes[key] = self.version
+        self.changes.move_to_end(key)
+
+    def changed_since(self, version):
+        # Return the parts changed after the provided version, oldest first
+        keys = []
+        for key in reversed(self.changes):
+            if self.changes[key] <= version:
+                break
+            keys.append(key)
+        return list(reversed(keys))
         
+    def snapshot(self):
+        # Return a copy of the Stage as it is now. Every pile is shared with
+        # this Stage until it changes here, so snapshots are cheap to keep
+        snapshot = Stage.__new__(Stage)
+        snapshot.__setstate__({"name": self.name,
+                               "team_dict": {name: team.copy() for name, team in self.team_dict.items()},
+                               "turn_number": self.turn_number,
+                               "bid_number": self.bid_number,
+                               "breakaway_started": self.breakaway_started,
+                               "format": self.format,
+                               "rng": StageRandom(self.rng.seed, self.rng.shuffles),
+                               "track": self.track,
+                               "positions": dict(self.positions),
+                               "resolved_turn": self.resolved_turn,
+                               "version": self.version})
+        return snapshot
+
     def from_stage(self, previous_stage):
-        # Take the result of the previous stage and create this new stage
-        display_string = "[b][u]Exhaustion cards carried over to {0}[/u][/b]\n".format(self.name)
-        
-        self.team_dict = previous_stage.team_dict
+        # Take the result of the previous stage and create this new stage,
+        # leaving the previous stage as it was
+        self.team_dict = {name: team.copy() for name, team in previous_stage.team_dict.items()}
+        self.format = previous_stage.format
+        self._attach()
         # Sort out all the decks
+        teams = []
         for team_name, team in self.team_dict.items():
-            
-            if FORMAT == Format.BBCODE:
-                display_string += "[COLOR={0}]".format(team.colour)
-            
+            riders = []
             for short, rider in team.riders.items():
                 (start, finish) = rider.perform_end_of_stage_actions()
-                display_string += "{0} {1}: {2} -> {3}\n".format(team_name, rider.name, start, finish)
+                riders.append((rider, start, finish))
+            teams.append((team, riders))
                 
-            if FORMAT == Format.BBCODE:
-                display_string += "[/COLOR]"
-                
-        return display_string
+        return "".join(self.formatter().carried_exhaustion(self.name, teams))
         
-    def add_team(self, team_name, team_player, team_colour):
-        self.team_dict[team_name] = Team(team_name, team_player, team_colour)
+    def add_team(self, team_name, team_player, team_colour, riders=DEFAULT_RIDERS, bot=False):
+        if team_name not in self.team_dict and len(self.team_dict) >= MAX_TEAMS:
+            raise ValueError("A stage can have at most {0} teams".format(MAX_TEAMS))
+        self.team_dict[team_name] = Team(team_name, team_player, team_colour, self.rng, riders, bot)
+        self._attach()
     
     def get_team(self, team_name):
         return self.team_dict[team_name]
 
+    def get_rider(self, team_name, short):
+        return self._riders[(team_name, short)]
+
+    # Track
+    # With a track the Stage resolves each movement phase itself, from the
+    # card each Rider played (see track.py)
+    def set_track(self, name):
+        self._track = get_track(name)
+        self.track = name
+        self.positions = {}
+
+    def get_track(self):
+        if self.track is None:
+            return None
+        if getattr(self, "_track", None) is None or self._track.name != self.track:
+            self._track = get_track(self.track)
+        return self._track
+
+    def place_riders(self, order=None):
+        # Place every Rider on the start area, returning the order used. By
+        # default Teams are placed in turn order, Riders by short name
+        if order is None:
+            order = [(team_name, short) for team_name in self.turn_order()
+                     for short in sorted(self.get_team(team_name).riders.keys())]
+        order = [tuple(key) for key in order]
+        self.positions = start_positions(self.get_track(), order)
+        self._clear_steps()
+        return order
+
+    def can_place_riders(self):
+        # Only before the first turn; Riders leave the track as they finish
+        return self.track is not None and len(self.positions) == 0 and self.turn_number == 0
+
+    def can_resolve_movement(self):
+        return (self.track is not None and len(self.positions) > 0 and self.turn_number > 0
+                and not self.breakaway_started and self.resolved_turn != self.turn_number
+                and self.all_riders_have_played_cards())
+
+    def resolve_movement(self):
+        # Move every Rider by the card it played, then slipstream and give out
+        # exhaustion. Finished Riders leave the track. Returns the Resolution,
+        # with Rider keys
+        moves = {key: card_value(rider.discard_pile[-1]) for key, rider in self._riders.items()
+                 if key in self.positions and not rider.finished_stage and len(rider.discard_pile) > 0}
+        resolution = resolve_turn(self.get_track(), self.positions, moves)
+        for key in resolution.exhausted:
+            self._riders[key].add_exhaustion()
+        for key in resolution.finished:
+            self._riders[key].finished_stage = True
+        self.positions = {key: position for key, position in resolution.after.items()
+                          if key not in resolution.finished}
+        self.resolved_turn = self.turn_number
+        self.resolution = resolution
+        self._clear_steps()
+        return resolution
+
+    def position_names(self):
+        # Return {(team_name, short): "Team Rider"} as shown with positions
+        return {key: "{0} {1}".format(key[0], rider.name) for key, rider in self._riders.items()}
+
+    def bot_moves(self):
+        # Return the moves of every bot Team holding cards, as for play_moves.
+        # Bots play their highest card
+        moves = {}
+        for team in self._teams:
+            if team.bot:
+                plays = ["{0}{1}".format(short.lower(), card_name(max(rider.drawn_cards, key=card_value)))
+                         for short, rider in sorted(team.riders.items()) if len(rider.drawn_cards) > 0]
+                if plays:
+                    moves[team.name] = " ".join(plays)
+        return moves
+
+    # Undo history
+    # Rider actions can be undone until the next phase. Each step holds the
+    # state of the Riders it changed, before and after, which is a handful of
+    # references per Rider as piles are shared rather than copied
+    def _step(self, action, keys, change):
+        riders = [self.get_rider(*key) for key in keys]
+        before = [rider.get_state() for rider in riders]
+        change()
+        after = [rider.get_state() for rider in riders]
+        if not after == before:
+            self.undo_steps.append((action, keys, before, after))
+            self.redo_steps.clear()
+
+    def _clear_steps(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+
+    def can_undo(self):
+        return len(self.undo_steps) > 0
+
+    def can_redo(self):
+        return len(self.redo_steps) > 0
+
+    def undo(self):
+        # Undo the last Rider action, returning (action, [(team_name, short)])
+        if not self.can_undo():
+            return None
+        step = self.undo_steps.pop()
+        action, keys, before, after = step
+        for key, state in zip(keys, before):
+            self.get_rider(*key).set_state(state)
+        self.redo_steps.append(step)
+        return action, keys
+
+    def redo(self):
+        # Redo the last undone Rider action, returning (action, [(team_name, short)])
+        if not self.can_redo():
+            return None
+        step = self.redo_steps.pop()
+        action, keys, before, after = step
+        for key, state in zip(keys, after):
+            self.get_rider(*key).set_state(state)
+        self.undo_steps.append(step)
+        return action, keys
+
+    def play_card(self, team_name, short, card_name):
+        rider = self.get_rider(team_name, short)
+        self._step("play", [(team_name, short)], lambda: rider.play_card(card_name))
+
+    def parse_moves(self, moves):
+        # Take {team_name: shorthand string} (eg. "r4 s5") and return the
+        # plays as [(team_name, short, card_name)], raising ValueError if any
+        # Rider doesn't hold the card it plays
+        plays = []
+        for team_name, play_string in sorted(moves.items()):
+            if team_name not in self.team_dict:
+                raise ValueError("Unknown team '{0}'".format(team_name))
+            team = self.team_dict[team_name]
+            for rider_string in play_string.split():
+                short = rider_string[0].upper()
+                if short not in team.riders:
+                    raise ValueError("{0} has no rider '{1}'".format(team_name, rider_string[0]))
+                rider = team.riders[short]
+                if any(p[0] == team_name and p[1] == short for p in plays):
+                    raise ValueError("{0} {1} plays more than once".format(team_name, rider.name))
+                try:
+                    card = card_code(rider_string[1:].lower())
+                except ValueError:
+                    raise ValueError("{0} {1}: '{2}' is not a card".format(team_name, rider.name, rider_string[1:]))
+                if card not in rider.drawn_cards:
+                    raise ValueError("{0} {1} doesn't hold a {2}".format(team_name, rider.name, card_name(card)))
+                plays.append((team_name, short, card_name(card)))
+        return plays
+
+    def play_moves(self, moves):
+        # Play every move of a turn, or none of them if any is invalid
+        plays = self.parse_moves(moves)
+        def play():
+            for team_name, short, card in plays:
+                self.get_rider(team_name, short).play_card(card)
+        self._step("play_turn", [(team_name, short) for team_name, short, card in plays], play)
+        return plays
+
+    def add_exhaustion(self, team_name, short):
+        rider = self.get_rider(team_name, short)
+        self._step("exhaustion", [(team_name, short)], rider.add_exhaustion)
+
+    def set_finished(self, team_name, short):
+        rider = self.get_rider(team_name, short)
+        def finish():
+            rider.finished_stage = True
+        self._step("finished", [(team_name, short)], finish)
+
+    def set_in_breakaway(self, team_name, short):
+        rider = self.get_rider(team_name, short)
+        def nominate():
+            rider.in_breakaway = True
+        self._step("in_breakaway", [(team_name, short)], nominate)
+
+    def set_breakaway_winner(self, team_name, short):
+        # Winner takes two exhaustion and keeps their played cards
+        rider = self.get_rider(team_name, short)
+        def win():
+            rider.add_exhaustion()
+            rider.add_exhaustion()
+            rider.shuffle_deck(False)
+            rider.in_breakaway = False
+        self._step("winner", [(team_name, short)], win)
+
+    def set_breakaway_loser(self, team_name, short):
+        # Loser gets their played cards back
+        rider = self.get_rider(team_name, short)
+        def lose():
+            rider.shuffle_deck(True)
+            rider.in_breakaway = False
+        self._step("loser", [(team_name, short)], lose)
+
+    def start_breakaway(self):
+        self.breakaway_started = True
+        self._clear_steps()
+
+    def turn_order(self):
+        # Return the Team names in a random order, the same for every request
+        # in a turn
+        team_list = [team.name for team in self._teams]
+        self.rng.derived("order", self.turn_number, self.bid_number).shuffle(team_list)
+        return team_list
+
     def perform_breakaway_energy_phase(self):
         # Perform breakaway
         self.breakaway_started = True;
         self.bid_number += 1
+        self._clear_steps()
         
         # Draw cards for all riders in breakaway
         for team_name, team in self.team_dict.items():
@@ -208,25 +858,20 @@ class Stage:
 
     def output_breakaway_energy_phase(self):
         # Outputs the last breakaway energy phase
-        display_string = "[b][u]Breakaway Turn {0} - Energy Phase[/u][/b]\n\n".format(self.bid_number)
-        
-        display_string = self._output_energy_phase(display_string, True)
-        
-        return display_string
+        return "".join(self.formatter().energy_phase(
+            self, "Breakaway Turn {0} - Energy Phase".format(self.bid_number), KEEP_DECK_SECRET, True))
     
     def output_breakaway_bid_phase(self):
         # Outputs the last breakaway bid phase
-        display_string = "[b][u]Breakaway Turn {0} - Bid Phase[/u][/b]\n\n".format(self.bid_number)
-        
-        display_string = self._output_movement_phase(display_string, True)
-            
-        return display_string
+        return "".join(self.formatter().movement_phase(
+            self, "Breakaway Turn {0} - Bid Phase".format(self.bid_number), KEEP_DECK_SECRET, True))
         
     def perform_energy_phase(self):
         self.breakaway_started = False;
         
         # Performs card draws for each rider
         self.turn_number += 1
+        self._clear_steps()
         for team_name, team in self.team_dict.items():
             for short, rider in team.riders.items():
                 if not rider.finished_stage:
@@ -234,106 +879,30 @@ class Stage:
 
     def output_energy_phase(self):
         # Outputs the last energy phase
-        display_string = "[b][u]Turn {0} - Energy Phase[/u][/b]\n\n".format(self.turn_number)
-        
-        display_string = self._output_energy_phase(display_string, False)
+        display_string = "".join(self.formatter().energy_phase(
+            self, "Turn {0} - Energy Phase".format(self.turn_number), KEEP_DECK_SECRET))
+
+        if SHOW_ODDS:
+            from odds import output_odds
+            display_string += output_odds(self)
+
+        if SHOW_EXACT_ODDS:
+            from odds import output_exact_odds
+            display_string += output_exact_odds(self)
 
         return display_string
     
-    def output_movement_phase(self):
-        # Outputs the last movement phase
-        display_string = "[b][u]Turn {0} - Movement Phase[/u][/b]\n".format(self.turn_number)
-        display_string += "Numbers in brackets are how many spaces the cyclist actually moved (if blocked or because of ascents/descents)\n\n"
-        
-        display_string = self._output_movement_phase(display_string, False)
-        
-        display_string += "Positions (before slipstream):\n"
-        display_string += "**INSERT IMAGE HERE**\n\n"
-        
-        display_string += "[b][u]Turn {0} - End Phase[/u][/b]\n".format(self.turn_number)
-        display_string += "Positions (after slipstream):\n"
-        display_string += "**INSERT IMAGE HERE**\n\n"
-        display_string += "[b]Exhaustion card(s):[/b]\n"
-        	
-        return display_string
+    def output_movement_phase(self, images=None):
+        # Outputs the last movement phase, with the URLs of its position
+        # images (before, after) if they were drawn
+        return "".join(self.formatter().movement_phase(
+            self, "Turn {0} - Movement Phase".format(self.turn_number), KEEP_DECK_SECRET, images=images))
 
-    def _output_energy_phase(self, display_string, breakaway = False):
-        for team_name, team in sorted(list(self.team_dict.items())):
-    
-            if FORMAT == Format.DISCOURSE:
-                display_string += "[b]{0} ({1})[/b]\n".format(team.name, team.player)
-            else:
-                display_string += "[COLOR={0}][b]{1} ({2})[/b][/COLOR]\n".format(team.colour, team.name, team.player)
-            
-            for short, rider in sorted(list(team.riders.items())):
-                
-                if (not rider.finished_stage) and ((not breakaway) or (breakaway and rider.in_breakaway)):
-                    if FORMAT == Format.DISCOURSE:
-                        display_string += "[details=\"{0}: {1}\"]\n".format(rider.name, rider.message)
-                        if KEEP_DECK_SECRET:
-                            display_string += "[b]Hand: {0}[/b] - Recycle: {1}\n".format(",".join(sorted(rider.drawn_cards)), ",".join(sorted(rider.recycle_pile)))
-                        else:
-                            display_string += "[b]Hand: {0}[/b] - Energy: {1} - Recycle: {2}\n".format(",".join(sorted(rider.drawn_cards)), ",".join(sorted(rider.energy_pile)), ",".join(sorted(rider.recycle_pile)))
-                        display_string += "[/details]\n"
-                    else:
-                        display_string += "[COLOR={0}]{1}: {2}[/COLOR]\n".format(team.colour, rider.name, rider.message)
-                        if KEEP_DECK_SECRET:
-                            display_string += "[o][b]Hand: {0}[/b] - Recycle: {1}[/o]\n".format(",".join(sorted(rider.drawn_cards))), ",".join(sorted(rider.recycle_pile))
-                        else:
-                            display_string += "[o][b]Hand: {0}[/b] - Energy: {1} - Recycle: {2}[/o]\n".format(",".join(sorted(rider.drawn_cards)), ",".join(sorted(rider.energy_pile)), ",".join(sorted(rider.recycle_pile)))
-                    
-                    display_string += "\n"
-            
-        return display_string
-        
-    def _output_movement_phase(self, display_string, breakaway = False):
-        for team_name, team in sorted(list(self.team_dict.items())):
-        
-            if FORMAT == Format.DISCOURSE:
-                display_string += "[b]{0} ({1})[/b]\n".format(team.name, team.player)
-            else:
-                display_string += "[COLOR={0}][b]{1} ({2})[/b]\n".format(team.colour, team.name, team.player)
-            
-            for short, rider in sorted(list(team.riders.items())):
-            
-                if (not rider.finished_stage) and ((not breakaway) or (breakaway and rider.in_breakaway)):
-                    cards_played = rider.get_last_cards_played()
-                    rider_card = None
-                    if len(cards_played) > 0:
-                        rider_card = cards_played[0]
-                    rider_deck = rider.get_deck_list()
-                    
-                    display_string += "{0}:\n".format(rider.name)
-                    if KEEP_DECK_SECRET:
-                        display_string += "[b]Card Played: {0}[/b]\n".format(str(rider_card))
-                    elif breakaway:
-                        if self.bid_number == 1:
-                            display_string += "[b]Card Played: {0}[/b]\n".format(str(rider_card))
-                        elif self.bid_number == 2:
-                            if len(cards_played) < 2:
-                                display_string += "[b]Card Played: None[/b]\n"   
-                            else:
-                                first_bid = cards_played[1]
-                                first_bid_int = self._card_to_int(first_bid)
-                                rider_card_int = self._card_to_int(rider_card)
-                                
-                                display_string += "[b]Card Played: {0}[{1}][/b]\n".format(str(rider_card), rider_card_int + first_bid_int)
-                    else:
-                        display_string += "[b]Card Played: {0}[/b] - Deck: {1}\n".format(str(rider_card), ",".join(rider_deck))
-                
-            if FORMAT == Format.DISCOURSE:
-                display_string += "\n\n"
-            else:
-                display_string += "[/COLOR]\n\n"		
-        
-        return display_string
+    def formatter(self):
+        # Return the formatter plugin for this Stage's posts
+        from formatters import get_formatter
+        return get_formatter(self.format)
      
-    def _card_to_int(self, card_string):
-        if card_string == "e2":
-            return 2
-        else:
-            return int(card_string)                                               
-                                                        
     def __str__(self):
         display_string = "{0}\n".format(self.name)
         display_string += "Bid Number: {0}\n".format(self.bid_number)
@@ -341,12 +910,3 @@ class Stage:
         for team_name, team in self.team_dict.items():
             display_string +=  "{0}\n".format(team)
         return display_string
-        
-def load_stage(filename):
-    with open(filename, 'rb') as f:
-        stage = pickle.load(f)	
-        return stage
-        
-def store_stage(filename, stage):
-    with open(filename, 'wb') as f:
-        pickle.dump(stage, f)
\ No newline at end of file
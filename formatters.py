@@ -0,0 +1,252 @@
+from collections import OrderedDict
+from heapq import merge
+from flammerouge import card_name, card_names, card_value
+from track import position_lines
+
+# Post formatters
+# ===============
+# Phase posts are generated as a stream of text fragments by a formatter
+# plugin. Each Stage names its formatter (Stage.format) and new formats are
+# added by subclassing Formatter and decorating the class with
+# @register_formatter. Formatters only decide how text is marked up; which
+# Riders and cards appear in each post is decided here, once for all formats.
+
+FORMATTERS = {}
+
+def register_formatter(cls):
+    """Class decorator which makes a formatter available to Stages."""
+    FORMATTERS[cls.name] = cls
+    return cls
+
+def get_formatter(name):
+    """Return the formatter registered under the provided name."""
+    try:
+        return FORMATTERS[name]()
+    except KeyError:
+        raise ValueError("Unknown post format '{0}'".format(name))
+
+def formatter_names():
+    """Return the names of all registered formatters."""
+    return sorted(FORMATTERS.keys())
+
+class RiderView:
+    """The sorted piles of a Rider, as they are shown in posts."""
+    __slots__ = ("name", "short_name", "message", "finished_stage", "in_breakaway",
+                 "hand", "energy", "recycle", "deck", "played")
+
+    def __init__(self, rider):
+        self.name = rider.name
+        self.short_name = rider.short_name
+        self.message = rider.message
+        self.finished_stage = rider.finished_stage
+        self.in_breakaway = rider.in_breakaway
+        energy = sorted(rider.energy_pile)
+        recycle = sorted(rider.recycle_pile)
+        self.hand = ",".join(card_names(sorted(rider.drawn_cards)))
+        self.energy = ",".join(card_names(energy))
+        self.recycle = ",".join(card_names(recycle))
+        self.deck = ",".join(card_names(merge(energy, recycle)))
+        # The last two cards played, most recent first
+        self.played = list(rider.discard_pile)[:-3:-1]
+
+def stage_views(stage):
+    """Return [(team, [RiderView])] for the Stage, sorted by name.
+
+    Posts take their views once up front, so each pile is sorted once per
+    phase rather than once for every line that shows it."""
+    views = OrderedDict((team.name, (team, [])) for team in stage.teams())
+    for (team_name, short), rider in stage.riders().items():
+        views[team_name][1].append(RiderView(rider))
+    return list(views.values())
+
+def _shown(view, breakaway):
+    return (not view.finished_stage) and ((not breakaway) or view.in_breakaway)
+
+class Formatter:
+    """Base formatter, generating every post from a few markup hooks."""
+    name = None
+
+    def heading(self, text):
+        return "[b][u]{0}[/u][/b]".format(text)
+
+    def bold(self, text):
+        return "[b]{0}[/b]".format(text)
+
+    def team_heading(self, team):
+        return self.bold("{0} ({1})".format(team.name, team.player)) + "\n"
+
+    def energy_rider(self, team, view, piles):
+        return "{0}: {1}\n{2}\n".format(view.name, view.message, piles)
+
+    def movement_team_start(self, team):
+        return self.team_heading(team)
+
+    def movement_team_end(self, team):
+        return "\n\n"
+
+    def movement_rider(self, team, view, card_text):
+        return "{0}:\n{1}\n".format(view.name, card_text)
+
+    def carried_team_start(self, team):
+        return ""
+
+    def carried_team_end(self, team):
+        return ""
+
+    def image_placeholder(self):
+        return "**INSERT IMAGE HERE**"
+
+    def positions(self, lines):
+        return "[code]\n{0}\n[/code]".format("\n".join(lines))
+
+    def image(self, url):
+        return "[img]{0}[/img]".format(url)
+
+    # Posts
+
+    def energy_phase(self, stage, title, secret, breakaway=False):
+        """Yield the post for an energy phase."""
+        views = stage_views(stage)
+        yield self.heading(title) + "\n\n"
+        for team, team_views in views:
+            yield self.team_heading(team)
+            for view in team_views:
+                if _shown(view, breakaway):
+                    piles = self.bold("Hand: {0}".format(view.hand))
+                    if not secret:
+                        piles += " - Energy: {0}".format(view.energy)
+                    piles += " - Recycle: {0}".format(view.recycle)
+                    yield self.energy_rider(team, view, piles)
+                    yield "\n"
+
+    def movement_phase(self, stage, title, secret, breakaway=False, images=None):
+        """Yield the cards played in a movement or bid phase.
+
+        images is the URLs of the position images (before, after) of a
+        movement phase resolved on the track, shown instead of the text."""
+        views = stage_views(stage)
+        resolved = stage.resolution is not None and stage.resolved_turn == stage.turn_number
+        # Riders which finished in this movement phase still show their card
+        finishing = set(stage.resolution.finished) if resolved and not breakaway else set()
+        yield self.heading(title) + "\n"
+        if not breakaway:
+            yield "Numbers in brackets are how many spaces the cyclist actually moved (if blocked or because of ascents/descents)\n"
+        yield "\n"
+        for team, team_views in views:
+            yield self.movement_team_start(team)
+            for view in team_views:
+                if _shown(view, breakaway) or (team.name, view.short_name) in finishing:
+                    card_text = self._card_played(stage, view, secret, breakaway)
+                    if card_text is not None:
+                        yield self.movement_rider(team, view, card_text)
+                    else:
+                        yield "{0}:\n".format(view.name)
+            yield self.movement_team_end(team)
+        if not breakaway:
+            before, after = self.image_placeholder(), self.image_placeholder()
+            if resolved:
+                # Resolved on the track, so the positions are known
+                track, names = stage.get_track(), stage.position_names()
+                before = self.positions(position_lines(track, stage.resolution.before, names))
+                after = self.positions(position_lines(track, stage.resolution.after, names))
+                if images is not None:
+                    before, after = self.image(images[0]), self.image(images[1])
+            yield "Positions (before slipstream):\n"
+            yield before + "\n\n"
+            yield self.heading("Turn {0} - End Phase".format(stage.turn_number)) + "\n"
+            yield "Positions (after slipstream):\n"
+            yield after + "\n\n"
+            yield self.bold("Exhaustion card(s):") + "\n"
+
+    def _card_played(self, stage, view, secret, breakaway):
+        rider_card = card_name(view.played[0]) if view.played else None
+        if secret or (breakaway and stage.bid_number == 1):
+            return self.bold("Card Played: {0}".format(rider_card))
+        if breakaway:
+            if stage.bid_number != 2:
+                return None
+            if len(view.played) < 2:
+                return self.bold("Card Played: None")
+            total = card_value(view.played[0]) + card_value(view.played[1])
+            return self.bold("Card Played: {0}[{1}]".format(rider_card, total))
+        return self.bold("Card Played: {0}".format(rider_card)) + " - Deck: {0}".format(view.deck)
+
+    def carried_exhaustion(self, stage_name, teams):
+        """Yield the exhaustion carried over to a new Stage.
+
+        teams is a list of (team, [(rider, start, finish)])."""
+        yield self.heading("Exhaustion cards carried over to {0}".format(stage_name)) + "\n"
+        for team, riders in teams:
+            yield self.carried_team_start(team)
+            for rider, start, finish in riders:
+                yield "{0} {1}: {2} -> {3}\n".format(team.name, rider.name, start, finish)
+            yield self.carried_team_end(team)
+
+@register_formatter
+class DiscourseFormatter(Formatter):
+    """Discourse flavoured BBCode, hiding each deck in a details block."""
+    name = "discourse"
+
+    def energy_rider(self, team, view, piles):
+        return "[details=\"{0}: {1}\"]\n{2}\n[/details]\n".format(view.name, view.message, piles)
+
+@register_formatter
+class BBCodeFormatter(Formatter):
+    """phpBB style BBCode, with each Team in its colour."""
+    name = "bbcode"
+
+    def team_heading(self, team):
+        return "[COLOR={0}]{1}[/COLOR]\n".format(team.colour, self.bold("{0} ({1})".format(team.name, team.player)))
+
+    def energy_rider(self, team, view, piles):
+        return "[COLOR={0}]{1}: {2}[/COLOR]\n[o]{3}[/o]\n".format(team.colour, view.name, view.message, piles)
+
+    def movement_team_start(self, team):
+        return "[COLOR={0}]{1}\n".format(team.colour, self.bold("{0} ({1})".format(team.name, team.player)))
+
+    def movement_team_end(self, team):
+        return "[/COLOR]\n\n"
+
+    def carried_team_start(self, team):
+        return "[COLOR={0}]".format(team.colour)
+
+    def carried_team_end(self, team):
+        return "[/COLOR]"
+
+@register_formatter
+class MarkdownFormatter(Formatter):
+    """Plain Markdown, with every Rider as a list item."""
+    name = "markdown"
+
+    def heading(self, text):
+        return "### {0}".format(text)
+
+    def bold(self, text):
+        return "**{0}**".format(text)
+
+    def team_heading(self, team):
+        return self.bold("{0} ({1})".format(team.name, team.player)) + "\n\n"
+
+    def energy_rider(self, team, view, piles):
+        return "- {0}: {1}\n  {2}\n".format(view.name, view.message, piles)
+
+    def movement_team_start(self, team):
+        return self.team_heading(team)
+
+    def movement_team_end(self, team):
+        return "\n"
+
+    def movement_rider(self, team, view, card_text):
+        return "- {0}: {1}\n".format(view.name, card_text)
+
+    def image_placeholder(self):
+        return "*INSERT IMAGE HERE*"
+
+    def positions(self, lines):
+        return "```\n{0}\n```".format("\n".join(lines))
+
+    def image(self, url):
+        return "![Positions]({0})".format(url)
+
+    def carried_team_start(self, team):
+        return "\n"
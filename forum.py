@@ -0,0 +1,144 @@
+import re
+import sys
+from collections import namedtuple
+
+# Forum thread ingestion
+# ======================
+# Players post their moves in [details] blocks using the Team.play_s
+# shorthand:
+#
+#   [details="Moves"]
+#   r4 s5
+#   [/details]
+#
+# A saved thread is read one line at a time and split into posts by the
+# header line each post starts with. Discourse raw exports (/raw/<topic>)
+# start posts with "username | 2019-03-04 10:00:00 UTC | #12" and phpBB
+# printable views with "Post by username » Mon Mar 04, 2019 10:00 am".
+# Posters are matched to a Team by its player and the last move posted by
+# each Team wins. A player with several Teams names the Team in the title of
+# each block, [details="Team name"]. Anything that can't be used is reported rather than
+# stopping the import.
+
+POST_HEADERS = {
+    "discourse": re.compile(r"^(?P<user>[^|\n]+?) \| [^|\n]+ \| #(?P<number>\d+)\s*$"),
+    "bbcode": re.compile(r"^Post by:? (?P<user>.+?) » .*$"),
+}
+_POST_SEPARATOR = re.compile(r"^-{5,}\s*$")
+_DETAILS = re.compile(r"\[details(?:=(?P<title>[^\]]*))?\](?P<body>.*?)\[/details\]", re.IGNORECASE | re.DOTALL)
+_MOVE = re.compile(r"^(?P<short>[A-Za-z])(?P<card>\d|[eE]2?)$")
+_QUOTE = re.compile(r"\[quote[^\]]*\].*?\[/quote\]", re.IGNORECASE | re.DOTALL)
+
+Post = namedtuple("Post", ("number", "user", "body"))
+Move = namedtuple("Move", ("number", "user", "play"))
+Problem = namedtuple("Problem", ("number", "user", "message"))
+
+def read_posts(lines, style="discourse"):
+    """Yield each Post in a thread, from an iterable of lines."""
+    header = POST_HEADERS[style]
+    number, user, body = None, None, []
+    count = 0
+    for line in lines:
+        match = header.match(line)
+        if match:
+            if user is not None:
+                yield Post(number, user, "".join(body))
+            count += 1
+            user = match.group("user").strip()
+            number = int(match.groupdict().get("number") or count)
+            body = []
+        elif user is not None and not _POST_SEPARATOR.match(line):
+            body.append(line)
+    if user is not None:
+        yield Post(number, user, "".join(body))
+
+def parse_move_block(text):
+    """Return the shorthand moves in a [details] block and any words that aren't moves."""
+    moves, malformed = [], []
+    for word in text.split():
+        match = _MOVE.match(word)
+        if match:
+            card = match.group("card").lower()
+            if card == "e":
+                card = "e2"
+            moves.append(match.group("short").lower() + card)
+        else:
+            malformed.append(word)
+    return moves, malformed
+
+def _block_team(title, team_names):
+    # The Team a block of moves is for, or None when it can't be told
+    if len(team_names) == 1:
+        return team_names[0]
+    title = (title or "").strip().strip("\"'").strip().lower()
+    for team_name in team_names:
+        if team_name.lower() == title:
+            return team_name
+    return None
+
+def extract_moves(posts, players=None, since=0):
+    """Return ({team_name: Move}, [Problem]) for the posts after since.
+
+    players maps lower case player names to a list of their Team names.
+    Without it every poster is treated as a Team of their own."""
+    moves, problems = {}, []
+    for post in posts:
+        if post.number <= since:
+            continue
+        team_names = [post.user] if players is None else players.get(post.user.lower(), [])
+        # Moves quoted from another post aren't the poster's own
+        found = {}
+        for match in _DETAILS.finditer(_QUOTE.sub("", post.body)):
+            block_moves, malformed = parse_move_block(match.group("body"))
+            if malformed and block_moves:
+                problems.append(Problem(post.number, post.user,
+                                        "Ignored '{0}' in moves".format(" ".join(malformed))))
+            if len(block_moves) == 0 or len(team_names) == 0:
+                found.setdefault(None, []).extend(block_moves)
+                continue
+            team_name = _block_team(match.group("title"), team_names)
+            if team_name is None:
+                problems.append(Problem(post.number, post.user,
+                                        "Moves don't name which of {0} they are for".format(", ".join(team_names))))
+                continue
+            found.setdefault(team_name, []).extend(block_moves)
+        if len(found.pop(None, [])) > 0:
+            problems.append(Problem(post.number, post.user, "Moves posted by someone without a team"))
+        for team_name, team_moves in found.items():
+            if team_name in moves:
+                problems.append(Problem(post.number, post.user,
+                                        "Replaces moves posted in #{0}".format(moves[team_name].number)))
+            moves[team_name] = Move(post.number, post.user, " ".join(team_moves))
+    return moves, problems
+
+def stage_players(stage):
+    """Map the lower case player of each Team in the Stage to its Team names."""
+    players = {}
+    for player, team_names in stage.players().items():
+        if player:
+            players.setdefault(player.lower(), []).extend(team_names)
+    return players
+
+def thread_moves(stage, lines, style="discourse", since=0):
+    """Return the valid moves in a thread for the Stage, and every problem found.
+
+    Each Team's moves are checked against its Riders' hands, and a Team with
+    an invalid move has none of its moves returned."""
+    moves, problems = extract_moves(read_posts(lines, style), stage_players(stage), since)
+    valid = {}
+    for team_name, move in sorted(moves.items()):
+        try:
+            stage.parse_moves({team_name: move.play})
+            valid[team_name] = move.play
+        except ValueError as e:
+            problems.append(Problem(move.number, move.user, str(e)))
+    return valid, problems
+
+if __name__ == "__main__":
+    # Print the moves in a saved thread: python forum.py <thread.txt> [style]
+    with open(sys.argv[1], encoding="utf-8") as f:
+        moves, problems = extract_moves(read_posts(f, sys.argv[2] if len(sys.argv) > 2 else "discourse"))
+    for user, move in sorted(moves.items()):
+        print("#{0} {1}: {2}".format(move.number, user, move.play))
+    for problem in problems:
+        print("#{0} {1}: {2}".format(problem.number, problem.user, problem.message))
@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+# Determines how much rendered HTML, in characters, is kept for reuse
+MAX_FRAGMENT_CHARS = 4 * 1024 * 1024
+
+class FragmentCache:
+    """Rendered UI fragments, keyed by everything they were rendered from.
+
+    Piles are immutable, so a key made of a Rider's piles and flags changes
+    whenever the Rider does and stays valid however the Stage was loaded.
+    The least recently used fragments are evicted once the cache holds more
+    than max_chars characters."""
+    def __init__(self, max_chars=MAX_FRAGMENT_CHARS):
+        self.max_chars = max_chars
+        self._fragments = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """Return the fragment for key, calling render() if it isn't cached."""
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        # Rendered outside the lock; two requests may render the same fragment
+        fragment = render()
+        with self._lock:
+            if key not in self._fragments:
+                self._fragments[key] = fragment
+                self._chars += len(fragment)
+                while self._chars > self.max_chars and len(self._fragments) > 1:
+                    old_key, old_fragment = self._fragments.popitem(last=False)
+                    self._chars -= len(old_fragment)
+        return fragment
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self._chars = 0
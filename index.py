@@ -1,315 +1,799 @@
+import json
 import os
-from flask import Flask, render_template, redirect, url_for, request, jsonify
+import queue
+import shutil
+import threading
+import time
+from enum import Enum
+from contextlib import contextmanager
+from functools import wraps
+from flask import Flask, Response, render_template, redirect, url_for, request, jsonify, g, abort, send_from_directory
+from flask import before_render_template, template_rendered
+from werkzeug.local import LocalProxy
 from flammerouge import *
 from random import randint
+from catalog import CATALOG_FILENAME, PAGE_SIZE, StageCatalog
+from formatters import formatter_names
+from fragments import FragmentCache
+import metrics
+from metrics import SIZE_BUCKETS, Counter, Histogram
+from forum import POST_HEADERS, thread_moves
+from odds import MAX_SAMPLES, MAX_TURNS, SAMPLES, TURNS, exact_stage, simulate_stage
+from persistence import PersistenceWorker
+from registry import StageRegistry
+from stagefile import dumps_stage, load_stage, read_header, write_stage_text
+from stagelog import StageLog, describe_stage
+from track import position_lines, track_names
+from trackimage import image_format, render_positions, text_colour
 
 app = Flask(__name__)
 
-phase_text = ""
-current_stage = None
-last_exhaustion = []
 stages_dir = "./stages/"
+stage_catalog = None
+# Held while the catalog is opened, so threaded requests share a single one
+catalog_lock = threading.Lock()
+
+# Determines whether stored states are written in the background
+WRITE_BEHIND = True
+
+# Stored files are given to the user running the server via sudo
+SUDO_OWNER = None
+if os.getenv('SUDO_UID') is not None:
+    SUDO_OWNER = (int(os.getenv('SUDO_UID')), int(os.getenv('SUDO_GID')))
+
+class Persistence(Enum):
+    STAGE_FILES = 1
+    LOG = 2
+
+# Determines whether every action writes a full .stage file of the Stage or
+# appends to the Stage's action log
+PERSISTENCE = Persistence.LOG
+
+# Determines whether resolved movement phases are posted with position images
+POSITION_IMAGES = True
+
+# Position images are stored in this folder of the Stage's folder
+IMAGES_FOLDER = "images"
+
+# Determines how often, in seconds, an idle event stream is kept alive
+KEEPALIVE = 15
+
+# Team names and colours offered when creating a Stage, up to MAX_TEAMS
+TEAM_SLOTS = [("Red", "#CD4C32"), ("Blue", "#3D7399"), ("Green", "#18A561"),
+              ("Black", "#4E4946"), ("White", "#DAD5BD"), ("Pink", "#F48D7C"),
+              ("Yellow", "#E8C547"), ("Purple", "#7A4E9C"), ("Orange", "#E8873A"),
+              ("Grey", "#9A9A9A"), ("Brown", "#8B5A3C"), ("Teal", "#2E8C8C")][:MAX_TEAMS]
+
+# Determines how many Team slots have their colour filled in; a slot without
+# a colour adds no Team
+FILLED_TEAM_SLOTS = 6
+
+# Determines which client addresses can read /metrics
+METRICS_ADDRESSES = ("127.0.0.1", "::1")
+
+# Metrics, collected while metrics.ENABLED is set
+REQUEST_SECONDS = Histogram("flammerouge_request_seconds", "Time to handle a request, by route", ("route", "method"))
+STORE_SECONDS = Histogram("flammerouge_store_seconds", "Time to store an action or a state", ("kind",))
+STATE_BYTES = Histogram("flammerouge_state_bytes", "Size of each stored state", buckets=SIZE_BUCKETS)
+LOAD_SECONDS = Histogram("flammerouge_load_seconds", "Time to load a stored Stage", ("kind",))
+TEMPLATES_RENDERED = Counter("flammerouge_templates_rendered_total", "Templates rendered, by template", ("template",))
+REQUEST_TEMPLATES = Histogram("flammerouge_request_templates", "Templates rendered by a request",
+                              buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+REQUEST_TEMPLATE_SECONDS = Histogram("flammerouge_request_template_seconds", "Time a request spent rendering templates")
+
+# The Stage (and its UI state) named in the URL of the current request
+current_session = LocalProxy(lambda: g.session)
+current_stage = LocalProxy(lambda: g.session.stage)
+
+# Stages
+# ======
+@app.url_value_preprocessor
+def pull_stage(endpoint, values):
+    """Look up the Stage named in the URL."""
+    if values and "stage_name" in values:
+        session = stage_registry.get(values.pop("stage_name"))
+        if session == None:
+            abort(404)
+        g.session = session
+
+@app.url_defaults
+def add_stage_name(endpoint, values):
+    """Add the current Stage name to URLs which expect it."""
+    if "stage_name" not in values and "session" in g:
+        if app.url_map.is_endpoint_expecting(endpoint, "stage_name"):
+            values["stage_name"] = g.session.stage.name
+
+@app.before_request
+def start_request():
+    """Note when the request started, for metrics and slow request profiles."""
+    if metrics.ENABLED or metrics.PROFILE_SLOWER_THAN is not None:
+        g.started = time.perf_counter()
+        g.templates = 0
+        g.template_seconds = 0.0
+        g.profile = metrics.start_profile()
+
+@app.teardown_request
+def finish_request(error):
+    """Record how long the request took."""
+    if "started" not in g:
+        return
+    seconds = time.perf_counter() - g.started
+    rule = request.url_rule.rule if request.url_rule is not None else "unknown"
+    REQUEST_SECONDS.observe(seconds, rule, request.method)
+    REQUEST_TEMPLATES.observe(g.templates)
+    REQUEST_TEMPLATE_SECONDS.observe(g.template_seconds)
+    if g.profile is not None:
+        metrics.stop_profile(g.profile, "{0} {1}".format(request.method, request.full_path.rstrip("?")), seconds)
+
+@before_render_template.connect_via(app)
+def start_template(sender, template, context, **extra):
+    """Note when a template started rendering."""
+    if "started" in g:
+        g.template_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def finish_template(sender, template, context, **extra):
+    """Count a rendered template against the request."""
+    if "template_started" in g:
+        g.templates += 1
+        g.template_seconds += time.perf_counter() - g.pop("template_started")
+        TEMPLATES_RENDERED.inc(template.name)
+
+def stage_route(rule, **options):
+    """Register a route under /stage/<name>/, holding that Stage's lock."""
+    def decorator(f):
+        @wraps(f)
+        def locked(*args, **kwargs):
+            g.session = stage_registry.acquire(g.session.stage.name)
+            if g.session is None:
+                abort(404)
+            try:
+                response = f(*args, **kwargs)
+                publish_changes()
+                return response
+            finally:
+                g.session.lock.release()
+        return app.route("/stage/<string:stage_name>" + rule, **options)(locked)
+    return decorator
+
+@contextmanager
+def open_stage(stage):
+    """Make the provided Stage the Stage for the rest of this request.
+
+    Its lock is held until the block ends, from before other requests can
+    see it."""
+    g.session = stage_registry.put(stage)
+    try:
+        yield g.session
+    finally:
+        g.session.lock.release()
 
 # Routes
 # ======
 @app.route("/")
 def root():
     """Display the menu."""
-    stage_name = None
-    if not current_stage == None:
-        stage_name = current_stage.name
-    return render_template("stage_options.html", current_stage = stage_name)
+    return render_template("stage_options.html", stage_names = stage_registry.names())
 
-@app.route("/stage")
+@stage_route("/")
 def stage():
     """Display the current Stage."""
-    if not current_stage == None:
-        return render_stage()
-    return redirect(url_for('root'))
+    return render_stage()
 
 @app.route("/new_stage")
 def new_stage():
     """Display the Stage creation form."""
-    return render_template("new_stage.html")
+    return render_template("new_stage.html", formats=formatter_names(), default_format=DEFAULT_FORMAT,
+                           teams=TEAM_SLOTS, filled=FILLED_TEAM_SLOTS, riders="".join(DEFAULT_RIDERS),
+                           tracks=track_names(),
+                           rider_types=sorted((short, name) for short, (name, deck) in RIDER_TYPES.items()))
 
 @app.route("/create_stage", methods=['POST'])
 def create_stage():
     """Create a new Stage from provided data.""" 
-    global current_stage
     if request.method == 'POST':
-        current_stage = Stage(request.form["stage_name"])
-        
-        for i in range(1,7):
-            team_name = request.form["team_name_"+str(i)]
-            team_colour = request.form["team_colour_"+str(i)]
-            team_player = request.form["team_player_"+str(i)] 
+        teams = []
+        for i in range(1, MAX_TEAMS + 1):
+            team_name = request.form.get("team_name_"+str(i), "")
+            team_colour = request.form.get("team_colour_"+str(i), "")
+            team_player = request.form.get("team_player_"+str(i), "")
             if not ((team_name == "") or (team_colour == "")):
-                current_stage.add_team(team_name, team_player, team_colour)
-        
-        root = os.path.join(stages_dir, current_stage.name)
-        create_folder_for_stage(root)
-            
-        # Store stage
-        store_phase("created")
-    return redirect(url_for('stage'))
+                try:
+                    riders = rider_types(request.form.get("team_riders_"+str(i)) or DEFAULT_RIDERS)
+                except ValueError as e:
+                    abort(400, "{0}: {1}".format(team_name, e))
+                teams.append((team_name, team_player, team_colour, riders,
+                              "team_bot_"+str(i) in request.form))
+
+        stage = Stage(request.form["stage_name"])
+        if request.form.get("format") in formatter_names():
+            stage.format = request.form["format"]
+        if request.form.get("track") in track_names():
+            stage.set_track(request.form["track"])
+        for team in teams:
+            stage.add_team(*team)
+
+        with open_stage(stage):
+            root = os.path.join(stages_dir, current_stage.name)
+            create_folder_for_stage(root)
+
+            # Store stage
+            record_action("created", "create", describe_stage(current_stage), durable=True)
+        return redirect(url_for('stage'))
+    return redirect(url_for('root'))
 
-@app.route("/new_stage_from")
+@stage_route("/new_stage_from")
 def new_stage_from():
     """Display all stored Stages and states to create a new Stage from."""
     return render_template("new_stage_from.html",
-                           stage_name = current_stage.name, files=get_files_for_stage(current_stage.name))
+                           stage_name = current_stage.name, files=get_files_for_stage(current_stage.name),
+                           tracks=track_names())
 
 @app.route("/create_stage_from", methods=['POST'])
 def create_stage_from():
     """Create a Stage from the provided Stage and state."""
-    global current_stage
     if request.method == 'POST':
-        current_stage_name = request.form["stage_name"]
+        previous_stage_name = request.form["stage_name"]
         stage_file = request.form["stage_file"]
         new_stage_name = request.form["new_stage_name"]
     
         if not new_stage_name == "":
             new_stage = Stage(new_stage_name)
-            current_stage = load_stage(os.path.join(stages_dir, current_stage_name, stage_file))
-            set_phase_text(new_stage.from_stage(current_stage))
-            current_stage = new_stage
-            
-            create_folder_for_stage(os.path.join(stages_dir, new_stage_name))
-            store_phase("created")
+            previous_stage = load_stage_file(previous_stage_name, stage_file)
+            phase_text = new_stage.from_stage(previous_stage)
+            if request.form.get("track") in track_names():
+                new_stage.set_track(request.form["track"])
+            with open_stage(new_stage):
+                set_phase_text(phase_text)
+
+                create_folder_for_stage(os.path.join(stages_dir, new_stage_name))
+                store_phase("created", durable=True)
+            return redirect(url_for('stage'))
             
-    return redirect(url_for('stage'))
+    return redirect(url_for('root'))
 
 @app.route("/view_stage_list")
 def view_stage_list():
     """Display all stored Stages and states."""
-    stages = get_stage_list()
+    page = max(request.args.get("page", 0, type=int), 0)
+    stages = get_stage_list(page)
     file_dict = {}
     for stage in stages:
         file_dict[stage] = get_files_for_stage(stage)
-    return render_template("view_stages.html", stage_names=stages, files=file_dict)
+    last_page = max(get_catalog().stage_count() - 1, 0) // PAGE_SIZE
+    return render_template("view_stages.html", stage_names=stages, files=file_dict,
+                           page=page, last_page=last_page)
 
 @app.route("/load_stage_state", methods=['POST'])
 def load_stage_state():
     """Loads a specified Stage state and displays it."""
-    global current_stage
     if request.method == 'POST':
         stage_name = request.form["stage_name"]
         stage_file = request.form["stage_file"]
-        path = os.path.join(stages_dir, stage_name, stage_file)
 
-        if os.path.isfile(path):
-            current_stage = load_stage(path)
-            set_phase_text("")
-    return redirect(url_for('stage'))
+        stage = load_stage_file(stage_name, stage_file)
+        if not stage == None:
+            # A loaded state starts a new undo history
+            stage._clear_steps()
+            with open_stage(stage):
+                if PERSISTENCE == Persistence.LOG:
+                    # Later actions continue from this state
+                    store_phase(os.path.splitext(stage_file)[0], durable=True)
+            return redirect(url_for('stage'))
+    return redirect(url_for('root'))
 
-@app.route("/winner/<string:team_name>/<string:short>/")
+@stage_route("/winner/<string:team_name>/<string:short>/")
 def winner(team_name, short):
     """Sets Rider as winner and returns JSON to update Rider."""
-    team = current_stage.get_team(team_name)
-    # Add two exhaustion
-    team.add_s(short+" "+short)
-    # Shuffle energy+recycle
-    team.riders[short].shuffle_deck(False)
-    team.riders[short].in_breakaway = False
-    store_phase("breakaway_"+str(current_stage.bid_number)+"_end")
+    current_stage.set_breakaway_winner(team_name, short)
+    record_action("breakaway_"+str(current_stage.bid_number)+"_end", "winner", team_name, short)
     
-    return json_update_rider(team.riders[short], team_name)
+    return json_update()
 
-@app.route("/loser/<string:team_name>/<string:short>/")
+@stage_route("/loser/<string:team_name>/<string:short>/")
 def loser(team_name, short):
     """Sets Rider as loser and returns JSON to update Rider."""
-    team = current_stage.get_team(team_name)
-    rider = team.riders[short]
-    # Shuffle deck
-    rider.shuffle_deck(True)
-    rider.in_breakaway = False
-    store_phase("breakaway_"+str(current_stage.bid_number)+"_end")
+    current_stage.set_breakaway_loser(team_name, short)
+    record_action("breakaway_"+str(current_stage.bid_number)+"_end", "loser", team_name, short)
     
-    return json_update_rider(rider, team_name)
+    return json_update()
 
-@app.route("/exhaustion/<string:team_name>/<string:short>/")
+@stage_route("/exhaustion/<string:team_name>/<string:short>/")
 def exhaustion(team_name, short):
     """ Adds exhaustion card to provided Rider and returns JSON to update Rider."""
-    global last_exhaustion
     team = current_stage.get_team(team_name)
-    rider = team.riders[short]
+    rider = current_stage.get_rider(team_name, short)
     # Add exhaustion
-    team.add_s(short)
-    last_exhaustion.append(team.name+" "+rider.name+"")
-    store_phase(str(current_stage.turn_number)+"_end")
+    current_stage.add_exhaustion(team_name, short)
+    current_session.last_exhaustion.append(team.name+" "+rider.name+"")
+    current_stage.touch(STAGE_OUTPUT)
+    record_action(str(current_stage.turn_number)+"_end", "exhaustion", team_name, short)
     
-    # Append exhaustion text
-    rider_dict = update_rider(rider, team_name)
-    stage_dict = update_stage()
-    stage_dict['#stage-output'] += ", ".join(last_exhaustion)
-    return jsonify({**rider_dict, **stage_dict })
+    return json_update()
 
-@app.route("/finished/<string:team_name>/<string:short>/")
+@stage_route("/finished/<string:team_name>/<string:short>/")
 def finished(team_name, short):
     """Sets Rider as finished and returns JSON to update Rider."""
-    team = current_stage.get_team(team_name)
-    rider = team.riders[short]
-    rider.finished_stage = True
-    store_phase(str(current_stage.turn_number)+"_end")
-    return json_update_rider(rider, team_name)
+    current_stage.set_finished(team_name, short)
+    record_action(str(current_stage.turn_number)+"_end", "finished", team_name, short)
+    return json_update()
 
-@app.route("/play/<string:team_name>/<string:short>/<string:play>")
+@stage_route("/play/<string:team_name>/<string:short>/<string:play>")
 def play(team_name, short, play):
     """Plays provided card and returns JSON to update Rider."""
-    team = current_stage.get_team(team_name)
-    team.play_s(short+play)
+    current_stage.play_card(team_name, short, play)
     
     if current_stage.breakaway_started:
-        store_phase("breakaway_"+str(current_stage.bid_number)+"_movement")
+        record_action("breakaway_"+str(current_stage.bid_number)+"_movement", "play", team_name, short, play)
         if all_riders_have_played_cards(True):
             set_phase_text(current_stage.output_breakaway_bid_phase())
     else:   
-        store_phase(str(current_stage.turn_number)+"_movement")
+        record_action(str(current_stage.turn_number)+"_movement", "play", team_name, short, play)
         if all_riders_have_played_cards():
-            set_phase_text(current_stage.output_movement_phase())
+            set_phase_text(movement_text())
+
+    return json_update()
+
+@stage_route("/play_turn", methods=['POST'])
+def play_turn():
+    """Plays every Team's cards for a turn at once and returns JSON to update the Stage.
+
+    Takes {"moves": {team_name: "r4 s5"}} as JSON, or a form field per Team."""
+    data = request.get_json(silent=True)
+    if data is not None:
+        moves = data.get("moves", {}) if isinstance(data, dict) else None
+        if not isinstance(moves, dict) or not all(isinstance(play, str) for play in moves.values()):
+            return jsonify({"error": "Expected {\"moves\": {team_name: \"r4 s5\"}}"}), 400
+    else:
+        moves = request.form.to_dict()
+    try:
+        play_moves(moves)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    data = client_changes()
+    data["phase_text"] = stage_output()
+    return jsonify(data)
 
-    return json_update_rider(team.riders[short], team_name)
+@stage_route("/import_moves", methods=['POST'])
+def import_moves():
+    """Finds the moves in a saved forum thread, playing them if 'apply' is set.
 
-@app.route("/in_breakaway/<string:team_name>/<string:short>")
+    Returns JSON of the valid moves and any problems found in the thread."""
+    style = request.form.get("style", "discourse")
+    if style not in POST_HEADERS:
+        return jsonify({"error": "Unknown thread style '{0}'".format(style)}), 400
+    since = request.form.get("since", 0, type=int)
+    if "thread" in request.files:
+        lines = (line.decode("utf-8", "replace") for line in request.files["thread"].stream)
+    else:
+        lines = request.form.get("thread", "").splitlines(True)
+    moves, problems = thread_moves(current_stage, lines, style, since)
+
+    data = {}
+    if request.form.get("apply") and moves:
+        play_moves(moves)
+        data = client_changes()
+        data["phase_text"] = stage_output()
+    data["moves"] = moves
+    data["problems"] = [problem._asdict() for problem in problems]
+    return jsonify(data)
+
+@stage_route("/undo")
+def undo():
+    """Undoes the last Rider action and returns JSON to update the Riders it changed."""
+    step = current_stage.undo()
+    if step is not None:
+        record_step(step, "undo")
+    return json_update()
+
+@stage_route("/redo")
+def redo():
+    """Redoes the last undone Rider action and returns JSON to update the Riders it changed."""
+    step = current_stage.redo()
+    if step is not None:
+        record_step(step, "redo")
+    return json_update()
+
+@stage_route("/in_breakaway/<string:team_name>/<string:short>")
 def in_breakaway(team_name, short):
     """Sets Rider as nominated and returns JSON to update Team."""
-    team = current_stage.get_team(team_name)
-    rider = team.riders[short]
-    rider.in_breakaway = True
-    rider_dict = {}
-    for rider in list(team.riders.values()):
-        updated_rider = update_rider_min(rider, team_name)
-        rider_dict = { **rider_dict, **updated_rider }
-    stage_dict = update_stage()
-    return jsonify({**rider_dict, **stage_dict })
-
-@app.route("/breakaway")
+    current_stage.set_in_breakaway(team_name, short)
+    record_action("breakaway_0_start", "in_breakaway", team_name, short)
+    return json_update()
+
+@stage_route("/breakaway")
 def breakaway():
     """Performs the 'Breakaway Phase' and displays the Stage."""
-    if not stage == None:
-        # Enable the rider selection
-        if not current_stage.breakaway_started:
-            current_stage.breakaway_started = True;
-        else:
-            current_stage.perform_breakaway_energy_phase()
-            store_phase("breakaway_"+str(current_stage.bid_number)+"_energy")
-            set_phase_text(current_stage.output_breakaway_energy_phase())
+    # Enable the rider selection
+    if not current_stage.breakaway_started:
+        current_stage.start_breakaway()
+        record_action("breakaway_0_start", "start_breakaway")
+    else:
+        current_stage.perform_breakaway_energy_phase()
+        record_phase("breakaway_"+str(current_stage.bid_number)+"_energy", "breakaway_energy")
+        set_phase_text(current_stage.output_breakaway_energy_phase())
     return redirect(url_for('stage'))
 
-@app.route("/energy")
+@stage_route("/energy")
 def energy():
     """Performs the 'Energy Phase' and displays the Stage."""
-    global last_exhaustion
-    last_exhaustion = []
+    current_session.last_exhaustion = []
     current_stage.perform_energy_phase()
-    store_phase(str(current_stage.turn_number)+"_energy")
+    record_phase(str(current_stage.turn_number)+"_energy", "energy")
     set_phase_text(current_stage.output_energy_phase())
     return redirect(url_for('stage'))
   
-@app.route("/determine_turn_order")
+@stage_route("/determine_turn_order")
 def determine_turn_order():
     """Returns JSON to display a random Team order."""
-    team_list = list(current_stage.team_dict.keys())
-    random.shuffle(team_list)
+    team_list = current_stage.turn_order()
     text = ""
     while len(team_list)>0:
         text += "{0}\n".format(team_list.pop(0))
     
     set_phase_text(text)
-    return jsonify(update_stage())
+    return json_update()
+  
+@stage_route("/place_riders")
+def place_riders():
+    """Places every Rider on the start area of the track, in turn order, and returns JSON to update the Stage."""
+    if not current_stage.can_place_riders():
+        return jsonify({"error": "The riders can't be placed on the track"}), 400
+    try:
+        order = current_stage.place_riders()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    record_action(str(current_stage.turn_number)+"_start", "place_riders", order)
+    set_phase_text(position_text(current_stage.positions))
+    return json_update()
+
+@stage_route("/resolve")
+def resolve():
+    """Resolves the movement phase on the track and returns JSON to update the Stage."""
+    if not current_stage.can_resolve_movement():
+        return jsonify({"error": "The movement phase can't be resolved yet"}), 400
+    resolution = current_stage.resolve_movement()
+    record_action(str(current_stage.turn_number)+"_end", "resolve")
+    names = current_stage.position_names()
+    current_session.last_exhaustion = [names[key] for key in resolution.exhausted]
+    if position_images():
+        store_position_images(resolution)
+    set_phase_text(movement_text())
+    return json_update()
+
+@stage_route("/play_bots")
+def play_bots():
+    """Plays the highest card of every bot Rider and returns JSON to update the Stage."""
+    play_moves(current_stage.bot_moves())
+    return json_update()
+
+@stage_route("/update")
+def update():
+    """Returns JSON to update everything changed since the client's version."""
+    return json_update()
+
+@app.route("/stage/<string:stage_name>/events")
+def events():
+    """Streams the changes to the Stage as server-sent events.
+
+    Each event is the same JSON as an action returns, rendered once for
+    every client watching the Stage."""
+    session = g.session = stage_registry.acquire(g.session.stage.name)
+    if session is None:
+        abort(404)
+    try:
+        first = json.dumps(client_changes())
+        subscriber = session.subscribe()
+    finally:
+        session.lock.release()
+
+    def stream():
+        try:
+            yield "data: {0}\n\n".format(first)
+            while True:
+                try:
+                    update = subscriber.updates.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    if subscriber.dropped:
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                if update is None:
+                    # The Stage was replaced or evicted; the client reconnects
+                    return
+                yield "data: {0}\n\n".format(update)
+        finally:
+            with session.lock:
+                session.unsubscribe(subscriber)
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/stage/<string:stage_name>/images/<string:filename>")
+def position_image(filename):
+    """Returns a stored position image of the Stage."""
+    persistence.flush()
+    return send_from_directory(os.path.join(stages_dir, g.session.stage.name, IMAGES_FOLDER), filename)
+
+@app.route("/metrics")
+def show_metrics():
+    """Returns every metric in the Prometheus text format, to local clients."""
+    if not metrics.ENABLED:
+        abort(404)
+    if request.remote_addr not in METRICS_ADDRESSES:
+        abort(403)
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@stage_route("/odds")
+def odds():
+    """Returns JSON of the best card odds for every unfinished Rider."""
+    # Simulations take memory in proportion to samples
+    turns = max(1, min(request.args.get("turns", TURNS, type=int), MAX_TURNS))
+    samples = max(1, min(request.args.get("samples", SAMPLES, type=int), MAX_SAMPLES))
+    return jsonify(simulate_stage(current_stage, turns, samples))
+
+@stage_route("/exact_odds")
+def exact_odds():
+    """Returns JSON of the exact odds of the next draw for every unfinished Rider."""
+    return jsonify(exact_stage(current_stage))
   
 # Helpers
 # =======
-def json_update_rider(rider, team_name):
-    """Return the JSON for a Rider update."""
-    rider_dict = update_rider(rider, team_name)
-    stage_dict = update_stage() 
-    return jsonify({**rider_dict, **stage_dict })
+def position_text(positions):
+    """Return the provided positions on the current Stage's track as text."""
+    return "\n".join(position_lines(current_stage.get_track(), positions, current_stage.position_names())) + "\n"
+
+def position_images():
+    """Return whether position images are drawn; the posts show text positions otherwise."""
+    return POSITION_IMAGES and image_format() is not None
+
+def position_image_names(turn):
+    """Return the file names of the position images of the provided turn."""
+    return tuple("{0}_{1}.{2}".format(turn, when, image_format()) for when in ("before", "after"))
+
+def store_position_images(resolution):
+    """Draw the positions before and after slipstream and store them with the Stage.
+
+    Only the Riders are drawn here, onto the track drawn once per layout."""
+    track = current_stage.get_track()
+    tokens = {key: (current_stage.get_team(key[0]).colour, key[1]) for key in resolution.before}
+    images = [render_positions(track, positions, tokens)
+              for positions in (resolution.before, resolution.after)]
+    directory = os.path.join(stages_dir, current_stage.name, IMAGES_FOLDER)
+    names = position_image_names(current_stage.turn_number)
+    def write():
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            update_owner(directory)
+        for name, image in zip(names, images):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(image)
+            update_owner(path)
+    persistence.submit(write)
+
+def movement_text():
+    """Return the movement phase post, with the position images if they were drawn."""
+    images = None
+    if position_images() and current_stage.resolved_turn == current_stage.turn_number:
+        images = tuple(url_for('position_image', filename=name, _external=True)
+                       for name in position_image_names(current_stage.turn_number))
+    return current_stage.output_movement_phase(images=images)
 
 def set_phase_text(text):
     """Set the phase text."""
-    global phase_text
-    phase_text = text
+    current_session.phase_text = text
+    current_stage.touch(STAGE_OUTPUT)
     
-def store_phase(filename):
-    """Store the current Stage with the provided filename."""
-    # /Stage_Name/filename.stage
-    directory = os.path.join(stages_dir, current_stage.name)
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+def update_owner(path):
+    """Give the provided path to the user running the server via sudo."""
+    if SUDO_OWNER is not None:
+        os.chown(path, *SUDO_OWNER)
+
+def store_phase(filename, durable=False):
+    """Store the current Stage with the provided filename.
+
+    The Stage is written in the background unless durable is set."""
+    stage = current_session.stage
+    if PERSISTENCE == Persistence.LOG:
+        # Replays from the snapshot start without undo history, so the live
+        # Stage mustn't keep any either
+        stage._clear_steps()
+    directory = os.path.join(stages_dir, stage.name)
+    # Shares every pile with the live Stage, so it's cheap to take here and
+    # is only written out in the background
+    snapshot = stage.snapshot()
+    phase = (stage.name, filename, stage.turn_number, stage.bid_number)
+    def write():
+        text = dumps_stage(snapshot)
+        # /Stage_Name/filename.stage
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            # Update owner
+            update_owner(directory)
+        if PERSISTENCE == Persistence.LOG:
+            # /Stage_Name/actions.log + /Stage_Name/NNNNN-filename.snap
+            log = StageLog(directory)
+            new_log = not log.exists()
+            path = os.path.join(directory, log.snapshot(filename, text))
+            if new_log:
+                update_owner(log.path)
+        else:
+            path = os.path.join(directory, "{0}.stage".format(filename))
+            write_stage_text(path, text)
         # Update owner
-        os.chown(directory, int(os.getenv('SUDO_UID')), int(os.getenv('SUDO_GID')))
-    path = os.path.join(stages_dir, current_stage.name, "{0}.stage".format(filename))
-    store_stage(path, current_stage)
-    # Update owner
-    os.chown(path, int(os.getenv('SUDO_UID')), int(os.getenv('SUDO_GID')))
+        update_owner(path)
+        size = os.path.getsize(path)
+        STATE_BYTES.observe(size)
+        catalog_phase(*phase, size)
+    # Each action rewrites the state file for its phase, so only the last of
+    # a run of writes to the same file needs making
+    key = None if PERSISTENCE == Persistence.LOG else os.path.join(directory, filename)
+    persistence.submit(STORE_SECONDS.timed("state")(write), key, durable)
+
+def record_action(filename, action, *args, durable=False):
+    """Record a single Rider action against the current Stage."""
+    if PERSISTENCE == Persistence.LOG:
+        directory = os.path.join(stages_dir, current_stage.name)
+        phase = (current_stage.name, filename, current_stage.turn_number, current_stage.bid_number)
+        def write():
+            log = StageLog(directory)
+            new_log = not log.exists()
+            size = log.append(filename, action, *args)
+            if new_log:
+                update_owner(log.path)
+            catalog_phase(*phase, size)
+        persistence.submit(STORE_SECONDS.timed("action")(write), durable=durable)
+    else:
+        store_phase(filename, durable)
+
+def record_phase(filename, action):
+    """Record a phase, followed by a snapshot for later loads to replay from."""
+    record_action(filename, action, durable=True)
+    if PERSISTENCE == Persistence.LOG:
+        store_phase(filename, durable=True)
+
+def play_moves(moves):
+    """Play a turn of moves for the current Stage, storing them once."""
+    current_stage.play_moves(moves)
+    if current_stage.breakaway_started:
+        record_action("breakaway_"+str(current_stage.bid_number)+"_movement", "play_turn", moves)
+        if all_riders_have_played_cards(True):
+            set_phase_text(current_stage.output_breakaway_bid_phase())
+    else:
+        record_action(str(current_stage.turn_number)+"_movement", "play_turn", moves)
+        if all_riders_have_played_cards():
+            set_phase_text(movement_text())
+
+def record_step(step, action):
+    """Record an undo or redo against the phase of the step it applied."""
+    step_action, keys = step
+    if current_stage.breakaway_started:
+        if step_action == "in_breakaway":
+            filename = "breakaway_0_start"
+        elif step_action in ("winner", "loser"):
+            filename = "breakaway_"+str(current_stage.bid_number)+"_end"
+        else:
+            filename = "breakaway_"+str(current_stage.bid_number)+"_movement"
+    elif step_action in ("exhaustion", "finished"):
+        filename = str(current_stage.turn_number)+"_end"
+    else:
+        filename = str(current_stage.turn_number)+"_movement"
+    if step_action == "exhaustion":
+        team_name, short = keys[0]
+        exhausted = current_stage.get_team(team_name).name+" "+current_stage.get_rider(team_name, short).name
+        if action == "redo":
+            current_session.last_exhaustion.append(exhausted)
+        elif exhausted in current_session.last_exhaustion:
+            current_session.last_exhaustion.remove(exhausted)
+        current_stage.touch(STAGE_OUTPUT)
+    record_action(filename, action)
+
+def catalog_phase(stage_name, filename, turn_number, bid_number, size):
+    """Record a stored state of a Stage in the catalog."""
+    get_catalog().add_snapshot(stage_name, filename, turn_number, bid_number, size)
+
+def get_catalog():
+    """Return the catalog of stored Stages, building it if it's missing."""
+    global stage_catalog
+    path = os.path.join(stages_dir, CATALOG_FILENAME)
+    with catalog_lock:
+        if stage_catalog == None or not stage_catalog.path == path:
+            if not os.path.isdir(stages_dir):
+                os.makedirs(stages_dir)
+            catalog = StageCatalog(path)
+            if catalog.is_new:
+                catalog.rebuild(stages_dir, scan_stage)
+            stage_catalog = catalog
+        return stage_catalog
+
+def scan_stage(stage_name):
+    """Return (label, time, size, turn, bid) for every stored state of a Stage on disk."""
+    directory = os.path.join(stages_dir, stage_name)
+    log = StageLog(directory)
+    if PERSISTENCE == Persistence.LOG and log.exists():
+        # Position in the log stands in for the time
+        return [(label, -i, None, None, None) for i, label in enumerate(log.labels())]
+    states = []
+    for file in os.listdir(directory):
+        if file.endswith(".stage"):
+            path = os.path.join(directory, file)
+            header = read_header(path)
+            states.append((os.path.splitext(file)[0], os.path.getctime(path), os.path.getsize(path),
+                           header["turn_number"], header["bid_number"]))
+    return states
+
+@LOAD_SECONDS.timed("latest")
+def load_latest_stage(stage_name):
+    """Load the most recent state of the specified Stage, or None."""
+    persistence.flush()
+    directory = os.path.join(stages_dir, stage_name)
+    if not os.path.isdir(directory):
+        return None
+    log = StageLog(directory)
+    if PERSISTENCE == Persistence.LOG and log.exists():
+        return log.load()
+    files = get_files_for_stage(stage_name)
+    if len(files) > 0:
+        return load_stage(os.path.join(directory, files[0]))
+    return None
+
+@LOAD_SECONDS.timed("state")
+def load_stage_file(stage_name, stage_file):
+    """Load the specified Stage state, or None if it doesn't exist."""
+    persistence.flush()
+    log = StageLog(os.path.join(stages_dir, stage_name))
+    if PERSISTENCE == Persistence.LOG and log.exists():
+        return log.load(os.path.splitext(stage_file)[0])
+    path = os.path.join(stages_dir, stage_name, stage_file)
+    if os.path.isfile(path):
+        return load_stage(path)
+    return None
     
-def get_stage_list():
-    """Return a list of all stored Stages."""
-    return sorted(os.listdir(stages_dir), reverse=True)
+def get_stage_list(page=None):
+    """Return a list of all stored Stages, or a single page of them."""
+    persistence.flush()
+    if page == None:
+        return get_catalog().stages()
+    return get_catalog().stages(page, PAGE_SIZE)
 
 def get_files_for_stage(stage_name):
     """Return a list of all files for the specified Stage."""
-    return sorted(os.listdir(os.path.join(stages_dir,stage_name)), key=lambda x: os.path.getctime(os.path.join(stages_dir,stage_name,x)), reverse=True);    
+    persistence.flush()
+    return ["{0}.stage".format(row[0]) for row in get_catalog().snapshots(stage_name)]
 
 def create_folder_for_stage(path):
     """Creates a folder at the provided path."""
+    persistence.flush()
+    get_catalog().add_stage(os.path.basename(os.path.normpath(path)))
     if os.path.exists(path):
         # If stage exists remove it
         for file in os.listdir(path):
-            os.remove(os.path.join(path, file))
+            if os.path.isdir(os.path.join(path, file)):
+                shutil.rmtree(os.path.join(path, file))
+            else:
+                os.remove(os.path.join(path, file))
     else:
         # Create directory
         os.makedirs(path)
         # Update owner
-        os.chown(path, int(os.getenv('SUDO_UID')), int(os.getenv('SUDO_GID')))
+        update_owner(path)
         
 def all_teams_have_nominated_rider():
     """Returns True if all Teams have a nominated Rider."""
-    if not current_stage == None:
-        for team in list(current_stage.team_dict.values()):
-            rider_found = False
-            for rider in list(team.riders.values()):
-                if rider.in_breakaway:
-                    rider_found = True
-            if not rider_found:
-                return False
-        return True
-    return False
+    return current_stage.all_teams_have_nominated_rider()
 
 def no_teams_have_nominated_rider():
     """Returns True if no Team has a nominated Rider."""
-    if not current_stage == None:
-        for team in list(current_stage.team_dict.values()):
-            for rider in list(team.riders.values()):
-                if rider.in_breakaway:
-                    return False
-        return True
-    return False
+    return current_stage.no_teams_have_nominated_rider()
 
 def are_unfinished_riders():
     """Returns True if there are Riders marked as unfinished."""
-    if not current_stage == None:
-        for team in list(current_stage.team_dict.values()):
-            for rider in list(team.riders.values()):
-                if not rider.finished_stage:
-                    return True
-    return False
+    return current_stage.are_unfinished_riders()
 
 def all_riders_have_played_cards(breakaway = False):
     """Returns True if all Riders have played a card."""
-    if not current_stage == None:
-        for team in list(current_stage.team_dict.values()):
-            for rider in list(team.riders.values()):
-                if breakaway:
-                    if rider.in_breakaway:
-                        if len(rider.drawn_cards) > 0:
-                           return False
-                else:
-                    if len(rider.drawn_cards) > 0:
-                        return False
-        return True
-    return False
+    return current_stage.all_riders_have_played_cards(breakaway)
 
 def can_perform_breakaway():
     """Determine whether the 'Perform Breakaway' option should be displayed."""
@@ -346,11 +830,7 @@ def can_display_in_breakaway(team_name):
     # If breakaway has been enabled, and no rider selected
     if not current_stage == None:
         if current_stage.breakaway_started and current_stage.bid_number == 0:
-            team = current_stage.get_team(team_name)
-            for rider in list(team.riders.values()):
-                if rider.in_breakaway:
-                    return False
-            return True
+            return not current_stage.team_has_nominated_rider(team_name)
     return False  
 
 def can_display_winner_loser(rider):
@@ -390,55 +870,50 @@ def can_display_next_stage():
 # ========= =========
 def render_stage():
     """Render the entire Stage UI."""
-    teams = []
-    for team_key in sorted(list(current_stage.team_dict.keys())):
-        teams.append(render_team(current_stage.team_dict[team_key]))
+    teams = [render_team(team) for team in current_stage.teams()]
     return render_template("stage.html", name=current_stage.name, teams=teams,
                            actions = render_stage_actions(),
-                           phase_text=phase_text)
+                           phase_text=stage_output(),
+                           version=current_stage.version, session=current_session.id)
 
 def render_stage_actions():
     """Render the Stage actions UI."""
-    return render_template("stage_actions.html",
-                           energy=can_perform_energy(),
-                           breakaway=can_perform_breakaway(),
-                           turn_order=can_display_turn_order(),
-                           next_stage=can_display_next_stage())
+    flags = stage_action_flags()
+    current_session.action_flags[STAGE_ACTIONS] = flags
+    return render_template("stage_actions.html", **flags)
 
 def render_team(team):
     """Render the entire Team UI."""
-    riders = []
-    for rider_key in sorted(list(team.riders.keys())):
-        riders.append(render_rider(team.riders[rider_key], team.name))
-    # Determine font colour from team colour relative brightness
-    r, g, b = bytearray.fromhex(team.colour.lstrip('#'))
-    y = 0.2126 * pow((r/255),2.2) +  0.7151 * pow((g/255),2.2)  +  0.0721 * pow((b/255),2.2)
-    text_colour = "black"
-    if y < 0.30:
-        text_colour = "white"
-    return render_template("team.html", name=team.name, riders=riders,
-                           colour=team.colour, text_colour=text_colour, player=team.player)
+    riders = tuple(render_rider(team.riders[short], team.name) for short in sorted(team.riders.keys()))
+    return fragment_cache.get(("team.html", team.name, team.player, team.colour, riders),
+                              lambda: render_template("team.html", name=team.name, riders=riders,
+                                                      colour=team.colour, text_colour=text_colour(team.colour),
+                                                      player=team.player))
 
 def render_rider(rider, team_name):
     """Render the entire Rider UI."""
-    deck = [render_drawn_cards("Hand", rider.drawn_cards, team_name, rider.short_name),
+    deck = (render_drawn_cards("Hand", rider.drawn_cards, team_name, rider.short_name),
             render_cards("Energy", rider.energy_pile, team_name, rider.short_name),
             render_cards("Recycle", rider.recycle_pile, team_name, rider.short_name),
-            render_cards("Discard", rider.discard_pile, team_name, rider.short_name)]
-
-    return render_template("rider.html", deck=deck, team=team_name,
-                           title = render_rider_title(rider, team_name),
-                           actions = render_actions(rider, team_name))
+            render_cards("Discard", rider.discard_pile, team_name, rider.short_name))
+    title = render_rider_title(rider, team_name)
+    actions = render_actions(rider, team_name)
+    return fragment_cache.get(("rider.html", team_name, deck, title, actions),
+                              lambda: render_template("rider.html", deck=deck, team=team_name,
+                                                      title=title, actions=actions))
 
 def render_cards(pile_name, cards, team_name, short_name):
     """Render the cards UI."""
-    return render_template("cards.html", name=pile_name, cards=cards, team=team_name,
-                           short=short_name)
+    return fragment_cache.get(("cards.html", pile_name, tuple(cards), team_name, short_name),
+                              lambda: render_template("cards.html", name=pile_name, cards=card_names(cards),
+                                                      team=team_name, short=short_name))
     
 def render_drawn_cards(pile_name, cards, team_name, short_name):
     """Render the hand UI."""
-    return render_template("cards_drawn.html", name=pile_name, cards=cards, team=team_name,
-                           short=short_name)
+    # Links in the hand and actions include the Stage name
+    return fragment_cache.get(("cards_drawn.html", current_stage.name, pile_name, tuple(cards), team_name, short_name),
+                              lambda: render_template("cards_drawn.html", name=pile_name, cards=card_names(cards),
+                                                      team=team_name, short=short_name))
 
 def render_rider_title(rider, team_name):
     """Render the Rider title UI."""
@@ -447,58 +922,151 @@ def render_rider_title(rider, team_name):
         message = "In Breakaway!"
     elif rider.finished_stage:
         message = "Finished Stage!"
-    return render_template("rider_title.html", name=rider.name, short=rider.short_name,
-                           team=team_name, message=message)
+    return fragment_cache.get(("rider_title.html", rider.name, rider.short_name, team_name, message),
+                              lambda: render_template("rider_title.html", name=rider.name, short=rider.short_name,
+                                                      team=team_name, message=message))
 
 def render_actions(rider, team_name):
     """Render the Rider actions UI."""
-    return render_template("actions.html", team=team_name, short=rider.short_name,
-                           winlose=can_display_winner_loser(rider),
-                           breakaway=can_display_in_breakaway(team_name),
-                           options=can_display_rider_options(rider))
+    flags = rider_action_flags(rider, team_name)
+    current_session.action_flags[(team_name, rider.short_name, ACTIONS)] = flags
+    return fragment_cache.get(("actions.html", current_stage.name, team_name, rider.short_name) + tuple(sorted(flags.items())),
+                              lambda: render_template("actions.html", team=team_name, short=rider.short_name, **flags))
 
 # Update Functions
 # ====== =========
-def update_stage():
-    """Update the Stage UI."""
-    data = {
-        '#stage-actions'           : render_stage_actions(),
-        '#stage-output'            : phase_text
-        }
-    return data
-
-def update_all_rider_actions():
-    """Update Rider actions UI for all Riders."""
-    data = {}
-    for team in list(current_stage.team_dict.values()):
-        for rider in list(team.riders.values()):
-            prefix = '#'+team.name + '-' + rider.short_name + '-'
-            data = {**data,
-                    prefix+"actions" : render_actions(rider, team.name),}
-    return data
+# Changes are recorded against (team name, rider short name, part) keys.
+# Stage-wide parts use an empty team name.
+ACTIONS = "actions"
+OUTPUT = "output"
+STAGE_ACTIONS = ("", None, ACTIONS)
+STAGE_OUTPUT = ("", None, OUTPUT)
+PILE_NAMES = {
+    "drawn_cards"  : "Hand",
+    "energy_pile"  : "Energy",
+    "recycle_pile" : "Recycle",
+    "discard_pile" : "Discard",
+    }
 
-def update_rider_min(rider, team_name):
-    """Update the Rider title UI, and Rider actions UI for all Riders."""
-    prefix = '#'+team_name + '-' + rider.short_name + '-'
-    data = {
-        prefix+"title"             : render_rider_title(rider, team_name),
-        **update_all_rider_actions()
+def stage_action_flags():
+    """Return which Stage actions should be displayed."""
+    return {
+        'energy'     : can_perform_energy(),
+        'breakaway'  : can_perform_breakaway(),
+        'turn_order' : can_display_turn_order(),
+        'next_stage' : can_display_next_stage(),
+        'bots'       : current_stage.bots_have_cards(),
+        'place'      : current_stage.can_place_riders(),
+        'resolve'    : current_stage.can_resolve_movement(),
+        'undo'       : current_stage.can_undo(),
+        'redo'       : current_stage.can_redo(),
         }
-    return data
 
-def update_rider(rider, team_name):
-    """Update the entire Rider UI."""
-    prefix = '#'+team_name + '-' + rider.short_name + '-'
-    data = {
-        prefix+"title"             : render_rider_title(rider, team_name),
-        prefix+"cards-Hand"        : render_drawn_cards("Hand", rider.drawn_cards, team_name, rider.short_name),
-        prefix+"cards-Energy"      : render_cards("Energy", rider.energy_pile, team_name, rider.short_name),
-        prefix+"cards-Recycle"     : render_cards("Recycle", rider.recycle_pile, team_name, rider.short_name),
-        prefix+"cards-Discard"     : render_cards("Discard", rider.discard_pile, team_name, rider.short_name),
-        **update_all_rider_actions()
+def rider_action_flags(rider, team_name):
+    """Return which Rider actions should be displayed."""
+    return {
+        'winlose'    : can_display_winner_loser(rider),
+        'breakaway'  : can_display_in_breakaway(team_name),
+        'options'    : can_display_rider_options(rider),
         }
+
+def stage_output():
+    """Return the phase text, followed by any exhaustion added this turn."""
+    return current_session.phase_text + ", ".join(current_session.last_exhaustion)
+
+def rider_action_context():
+    """Return the Stage state every Rider's actions depend on."""
+    return (current_stage.breakaway_started, current_stage.bid_number,
+            current_stage.turn_number > 0, all_riders_have_played_cards())
+
+def refresh_actions():
+    """Record a change for any actions which are now displayed differently."""
+    flags = current_session.action_flags
+    if not flags.get(STAGE_ACTIONS) == stage_action_flags():
+        current_stage.touch(STAGE_ACTIONS)
+    # Rider actions depend on the Stage state, their Team's nomination and
+    # the Rider itself, so while the Stage state is the same only the Teams
+    # changed since the last refresh need checking
+    context = rider_action_context()
+    if context == current_session.action_context:
+        teams = set(key[0] for key in current_stage.changed_since(current_session.actions_version) if key[0])
+        riders = [((team_name, short), rider) for team_name in sorted(teams)
+                  for short, rider in sorted(current_stage.get_team(team_name).riders.items())]
+    else:
+        riders = list(current_stage.riders().items())
+    for (team_name, short), rider in riders:
+        key = (team_name, short, ACTIONS)
+        if not flags.get(key) == rider_action_flags(rider, team_name):
+            current_stage.touch(key)
+    current_session.action_context = context
+    current_session.actions_version = current_stage.version
+
+def all_changes():
+    """Return every part of the Stage UI."""
+    keys = [STAGE_ACTIONS, STAGE_OUTPUT]
+    for team_name, short in current_stage.riders():
+        for part in [STATUS, ACTIONS] + list(PILE_NAMES.keys()):
+            keys.append((team_name, short, part))
+    return keys
+
+def update_part(key):
+    """Render the UI for a single changed part of the Stage."""
+    team_name, short, part = key
+    if key == STAGE_ACTIONS:
+        return '#stage-actions', render_stage_actions()
+    if key == STAGE_OUTPUT:
+        return '#stage-output', stage_output()
+    rider = current_stage.get_rider(team_name, short)
+    prefix = '#'+team_name + '-' + short + '-'
+    if part == STATUS:
+        return prefix+"title", render_rider_title(rider, team_name)
+    if part == ACTIONS:
+        return prefix+"actions", render_actions(rider, team_name)
+    if part == "drawn_cards":
+        return prefix+"cards-Hand", render_drawn_cards("Hand", rider.drawn_cards, team_name, short)
+    return prefix+"cards-"+PILE_NAMES[part], render_cards(PILE_NAMES[part], getattr(rider, part), team_name, short)
+
+def update_changes(version, session_id):
+    """Update the parts of the Stage UI changed since the provided version.
+
+    Versions count from when the Stage was loaded, so a version is only
+    known if it comes with the id of the current session."""
+    refresh_actions()
+    if session_id != current_session.id or version < 0 or version > current_stage.version:
+        # Unknown version, eg. the Stage has been reloaded
+        keys = all_changes()
+    else:
+        keys = current_stage.changed_since(version)
+    data = { 'version' : current_stage.version, 'session' : current_session.id }
+    for key in keys:
+        selector, html = update_part(key)
+        data[selector] = html
     return data
 
+def publish_changes():
+    """Send the changes since the last update published to clients watching the Stage."""
+    session = g.session
+    if len(session.subscribers) == 0:
+        session.published_version = current_stage.version
+        return
+    data = update_changes(session.published_version, session.id)
+    if data['version'] != session.published_version:
+        data['since'] = session.published_version
+        session.publish(json.dumps(data), data['version'])
+
+def client_changes():
+    """Update the parts of the Stage UI changed since the client's version."""
+    return update_changes(request.args.get("v", -1, type=int), request.args.get("s"))
+
+def json_update():
+    """Return the JSON for all changes since the version the client has."""
+    return jsonify(client_changes())
+
+stage_registry = StageRegistry(load_latest_stage)
+# Rendered fragments, shared by every Stage
+fragment_cache = FragmentCache()
+persistence = PersistenceWorker(enabled=WRITE_BEHIND)
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=80, debug=True)
     
\ No newline at end of file
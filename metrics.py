@@ -0,0 +1,174 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+from functools import wraps
+
+# Metrics
+# =======
+# Counters and latency histograms, served on /metrics in the Prometheus text
+# format. Metrics are module level objects, created where they are observed:
+#
+#   DRAWS = Counter("flammerouge_draws_total", "Hands drawn, by how", ("draw",))
+#   DRAWS.inc("shuffled")
+#
+# Label values are given in the order the label names were. While metrics
+# are disabled, inc, observe and timed return straight away.
+
+# Determines whether metrics are collected
+ENABLED = False
+
+# Determines how slow, in seconds, a request has to be for its profile to be
+# logged. Requests are only profiled while this is set
+PROFILE_SLOWER_THAN = None
+# Number of functions logged for a slow request
+PROFILE_LINES = 25
+
+# Latency buckets, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Size buckets, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A count that only goes up, for each combination of label values."""
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *values, amount=1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ["{0}{1} {2}".format(self.name, _labels(self.labels, key), _number(value))
+                for key, value in values]
+
+class Histogram:
+    """Observations counted into buckets, for each combination of label values."""
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # {label values: [count in each bucket and above the last, sum]}
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *values):
+        if not ENABLED:
+            return
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            counts = self._values.get(values)
+            if counts is None:
+                counts = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def timed(self, *values):
+        """Decorate a function to observe how long each call takes."""
+        def decorator(f):
+            @wraps(f)
+            def timed_call(*args, **kwargs):
+                if not ENABLED:
+                    return f(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, *values)
+            return timed_call
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name, _labels(self.labels, key, [("le", _number(float(bound)))]), total))
+            lines.append("{0}_sum{1} {2}".format(self.name, _labels(self.labels, key), _number(counts[-1])))
+            lines.append("{0}_count{1} {2}".format(self.name, _labels(self.labels, key), total))
+        return lines
+
+def render():
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+        lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+        lines += metric.samples()
+    return "\n".join(lines) + "\n"
+
+# Slow request profiling
+
+# Only one request is profiled at a time; Python allows a single profiler
+_profiling = threading.Lock()
+
+def start_profile():
+    """Start profiling the current request, returning the profile or None."""
+    if PROFILE_SLOWER_THAN is None or not _profiling.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler, eg. a debugger, is already running
+        _profiling.release()
+        return None
+    return profile
+
+def stop_profile(profile, description, seconds):
+    """Stop profiling a request, passing it to slow_request if it took too long."""
+    profile.disable()
+    _profiling.release()
+    if PROFILE_SLOWER_THAN is not None and seconds >= PROFILE_SLOWER_THAN:
+        slow_request(description, seconds, profile)
+
+def log_slow_request(description, seconds, profile):
+    """Log the functions a slow request spent the most time in."""
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    logger.warning("Slow request %s took %.3fs\n%s", description, seconds, output.getvalue())
+
+# Called with (description, seconds, cProfile.Profile) for every slow request;
+# replace to keep profiles elsewhere
+slow_request = log_slow_request
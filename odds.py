@@ -0,0 +1,320 @@
+import math
+from collections import Counter
+from functools import lru_cache
+from flammerouge import EXHAUSTION, card_name, card_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Hand odds
+# =========
+# Monte Carlo estimate of the hands each Rider will draw over the next few
+# turns. Every sample is one row of a (riders * samples, deck) array, so all
+# Riders are simulated together with the same draw_cards rules:
+#   - 4 or more cards in the energy pile: take the top 4
+#   - no cards left: draw a single exhaustion card
+#   - fewer than 4 cards left in total: take everything
+#   - otherwise: take the energy pile, shuffle the recycle pile and top up
+# The order of the energy pile is hidden from players, so it is shuffled for
+# each sample. Each turn the Rider plays its best card and recycles the rest.
+
+# Determines the default number of samples and turns simulated per Rider.
+# 2000 samples put each odd within about a percent, as finely as posts show
+SAMPLES = 2000
+TURNS = 3
+# Determines the most samples and turns a request can ask for
+MAX_SAMPLES = SAMPLES * 4
+MAX_TURNS = 10
+
+HAND_SIZE = 4
+# Number of most likely hands reported for each turn
+TOP_HANDS = 5
+
+_NO_CARD = 0
+_HAND_BASE = HAND_SIZE + 1
+# A hand's key is the sum of these for its cards, which counts each card
+_HAND_KEYS = _HAND_BASE ** np.arange(EXHAUSTION + 1, dtype=np.int64) if np is not None else None
+# Bits of each shuffle sort key below the random part, holding the card
+_CARD_BITS = 4
+
+def _check_numpy():
+    if np is None:
+        raise RuntimeError("Hand odds require numpy")
+
+def _pile_array(piles, width):
+    # Stack equal length piles into an array padded to width
+    array = np.zeros((len(piles), width), dtype=np.uint8)
+    for i, pile in enumerate(piles):
+        array[i, :len(pile)] = pile
+    return array
+
+def _shuffled(array, rng):
+    # Shuffle each row independently, by sorting random keys that hold the
+    # card in their low bits; sorting values is much faster than argsort
+    keys = rng.integers(0, 1 << (32 - _CARD_BITS), array.shape, dtype=np.uint32)
+    keys <<= _CARD_BITS
+    keys |= array
+    keys.sort(axis=1)
+    return (keys & ((1 << _CARD_BITS) - 1)).astype(np.uint8)
+
+def _best_card(hand):
+    # Return the best card code of a known hand
+    return max(hand, key=card_value)
+
+def _hand_keys(hands):
+    # Key hands by how many of each card they hold, so order is ignored
+    keys = _HAND_KEYS[hands[:, 0]]
+    for column in range(1, hands.shape[1]):
+        keys += _HAND_KEYS[hands[:, column]]
+    return keys
+
+def _hand_summary(keys, weight):
+    # Return the most likely hands, from their keys, as [[card names], probability]
+    unique, counts = np.unique(keys, return_counts=True)
+    summary = []
+    for i in np.argsort(-counts, kind="stable")[:TOP_HANDS]:
+        key = int(unique[i])
+        codes = []
+        for code in range(EXHAUSTION + 1):
+            key, count = divmod(key, _HAND_BASE)
+            if code != _NO_CARD:
+                codes += [code] * count
+        summary.append([[card_name(c) for c in codes], float(counts[i]) * weight])
+    return summary
+
+def _simulate_group(energy, recycle, turns, samples, rng):
+    # Simulate decks which all have the same number of energy and recycle
+    # cards. Pile sizes then evolve identically, so every sample takes the
+    # same draw_cards branch each turn and piles can be sliced rather than
+    # indexed per sample.
+    values = np.array([card_value(c) if c != _NO_CARD else 0 for c in range(EXHAUSTION + 1)], dtype=np.uint8)
+    e, r = len(energy[0]), len(recycle[0])
+    width = e + r + HAND_SIZE
+    rows = len(energy) * samples
+    row_index = np.arange(rows)
+
+    E = np.repeat(_pile_array(energy, width), samples, axis=0)
+    E[:, :e] = _shuffled(E[:, :e], rng)
+    R = np.repeat(_pile_array(recycle, width), samples, axis=0)
+    p = 0
+
+    simulated = []
+    for turn in range(turns):
+        total = e + r
+        reshuffle = False
+        hand = np.zeros((rows, HAND_SIZE), dtype=np.uint8)
+        if e >= HAND_SIZE:
+            hand[:] = E[:, p:p+HAND_SIZE]
+            p += HAND_SIZE
+            e -= HAND_SIZE
+        elif total == 0:
+            hand[:, 0] = EXHAUSTION
+        elif total < HAND_SIZE:
+            hand[:, :e] = E[:, p:p+e]
+            hand[:, e:total] = R[:, :r]
+            e, r = 0, 0
+        else:
+            reshuffle = True
+            shuffled = _shuffled(R[:, :r], rng)
+            hand[:, :e] = E[:, p:p+e]
+            hand[:, e:] = shuffled[:, :HAND_SIZE-e]
+            E = np.zeros_like(E)
+            E[:, :total-HAND_SIZE] = shuffled[:, HAND_SIZE-e:]
+            p, e, r = 0, total - HAND_SIZE, 0
+
+        # Play the best card and recycle the rest
+        size = max(min(total, HAND_SIZE), 1)
+        # Column by column, as argmax is slow along short rows; the first
+        # of equal values is played, as draw_cards' callers do
+        columns = [values[hand[:, column]] for column in range(HAND_SIZE)]
+        best = columns[0]
+        for column in columns[1:]:
+            best = np.maximum(best, column)
+        best_col = np.full(rows, HAND_SIZE - 1, dtype=np.intp)
+        for column in range(HAND_SIZE - 2, -1, -1):
+            best_col[columns[column] == best] = column
+        if size > 1:
+            R[:, r:r+size] = hand[:, :size]
+            R[row_index, r + best_col] = hand[:, size-1]
+            r += size - 1
+
+        simulated.append((_hand_keys(hand), best, reshuffle))
+    return simulated
+
+def simulate_riders(riders, turns=TURNS, samples=SAMPLES, seed=None):
+    """Estimate hands and best cards for the next turns of each Rider.
+
+    Returns one dict per Rider with a list of turns, each holding the most
+    likely hands, the chance of each best card value and the chance of the
+    deck being shuffled."""
+    _check_numpy()
+    rng = np.random.default_rng(seed)
+
+    # A Rider with a hand already drawn plays it before anything is sampled.
+    # Riders with identical decks share one simulation.
+    decks, rider_decks = {}, []
+    for rider in riders:
+        recycle_pile = list(rider.recycle_pile)
+        hand = sorted(rider.drawn_cards)
+        if hand:
+            rest = list(hand)
+            rest.remove(_best_card(hand))
+            recycle_pile += rest
+        deck = (tuple(sorted(rider.energy_pile)), tuple(sorted(recycle_pile)), tuple(hand))
+        decks.setdefault(deck, len(decks))
+        rider_decks.append(deck)
+
+    # Decks with the same pile sizes are simulated together
+    groups = {}
+    for deck in decks:
+        groups.setdefault((len(deck[0]), len(deck[1]), len(deck[2]) > 0), []).append(deck)
+
+    weight = 1.0 / samples
+    deck_turns = {}
+    for (e, r, known), group in groups.items():
+        simulated = _simulate_group([d[0] for d in group], [d[1] for d in group],
+                                    turns - int(known), samples, rng)
+        for i, deck in enumerate(group):
+            rows = slice(i * samples, (i + 1) * samples)
+            turns_i = []
+            if known:
+                best = _best_card(deck[2])
+                turns_i.append({"hands": [[[card_name(c) for c in deck[2]], 1.0]],
+                                "best": {str(card_value(best)): 1.0},
+                                "reshuffle": 0.0})
+            for keys, best, reshuffle in simulated:
+                counts = np.bincount(best[rows])
+                turns_i.append({"hands": _hand_summary(keys[rows], weight),
+                                "best": {str(v): float(c) * weight for v, c in enumerate(counts) if c > 0},
+                                "reshuffle": float(reshuffle)})
+            deck_turns[deck] = turns_i
+
+    return [{"name": rider.name, "short": rider.short_name, "turns": deck_turns[deck]}
+            for rider, deck in zip(riders, rider_decks)]
+
+def simulate_stage(stage, turns=TURNS, samples=SAMPLES, seed=None):
+    """Estimate hand odds for every unfinished Rider in the Stage."""
+    riders = [(team_name, rider) for (team_name, short), rider in stage.riders().items()
+              if not rider.finished_stage]
+
+    odds = {}
+    results = simulate_riders([rider for team_name, rider in riders], turns, samples, seed)
+    for (team_name, rider), result in zip(riders, results):
+        odds.setdefault(team_name, {})[rider.short_name] = result
+    return odds
+
+def output_odds(stage, turns=TURNS, samples=SAMPLES, seed=None):
+    """Outputs the best card odds for every unfinished Rider."""
+    display_string = stage.formatter().heading("Best Card Odds (next {0} turns)".format(turns)) + "\n"
+    for team_name, team_odds in simulate_stage(stage, turns, samples, seed).items():
+        for short, result in sorted(team_odds.items()):
+            turn_strings = []
+            for turn in result["turns"]:
+                best = sorted(turn["best"].items(), key=lambda x: -x[1])[:3]
+                turn_strings.append(", ".join("{0} {1:.0%}".format(v, p) for v, p in best))
+            display_string += "{0} {1}: {2}\n".format(team_name, result["name"], " | ".join(turn_strings))
+    return display_string + "\n"
+
+# Exact odds
+# ==========
+# Exact chances for the next draw_cards of each Rider, counted rather than
+# sampled and without numpy. From the player's side the energy pile is in a
+# random order, so the next hand is one of three cases:
+#   - 4 or more cards in the energy pile: 4 cards drawn from the energy pile
+#   - fewer than 4 cards left in total (or none): a known hand
+#   - otherwise: the whole energy pile, topped up from the reshuffled recycle
+#     pile
+# Drawing k cards from a pile holding n_i of each card gives a hand holding
+# k_i of each with probability prod(C(n_i, k_i)) / C(n, k). A Rider with a
+# hand already drawn is assumed to play its best card first, as above.
+# Results depend only on how many of each card the piles hold, and are cached
+# on that, as most Riders share a few deck compositions.
+
+# Determines how many deck compositions are remembered
+EXACT_CACHE_SIZE = 4096
+
+def _signature(cards):
+    # Return the multiset of cards as ((card, count), ...)
+    return tuple(sorted(Counter(cards).items()))
+
+def next_draw(rider):
+    """Return (known cards, pile signature, cards drawn from it, reshuffle) for the next draw."""
+    energy = list(rider.energy_pile)
+    recycle = list(rider.recycle_pile)
+    hand = list(rider.drawn_cards)
+    if hand:
+        hand.remove(_best_card(hand))
+        recycle += hand
+    total = len(energy) + len(recycle)
+    if len(energy) >= HAND_SIZE:
+        return (), _signature(energy), HAND_SIZE, False
+    if total == 0:
+        return (EXHAUSTION,), (), 0, False
+    if total < HAND_SIZE:
+        return tuple(sorted(energy + recycle)), (), 0, False
+    return tuple(sorted(energy)), _signature(recycle), HAND_SIZE - len(energy), True
+
+def _draws(pile, count):
+    # Yield (cards, ways) for every distinct set of count cards from the pile
+    # signature, where ways is the number of ways of drawing it
+    if count == 0:
+        yield (), 1
+        return
+    if not pile:
+        return
+    (card, number), rest = pile[0], pile[1:]
+    remaining = sum(n for c, n in rest)
+    for taken in range(max(0, count - remaining), min(number, count) + 1):
+        ways = math.comb(number, taken)
+        for cards, rest_ways in _draws(rest, count - taken):
+            yield (card,) * taken + cards, ways * rest_ways
+
+@lru_cache(maxsize=EXACT_CACHE_SIZE)
+def draw_odds(known, pile, count, reshuffle):
+    """Return the exact odds of a draw described by next_draw.
+
+    The returned dict is shared by every Rider with the same draw, so it must
+    not be changed."""
+    # Chances are summed as whole numbers of ways and divided at the end
+    total = math.comb(sum(n for c, n in pile), count)
+    hands = sorted(((tuple(sorted(known + cards)), ways) for cards, ways in _draws(pile, count)),
+                   key=lambda hand: -hand[1])
+
+    best, at_least = Counter(), Counter()
+    exhaustion_only = 0
+    for hand, ways in hands:
+        best[str(card_value(_best_card(hand)))] += ways
+        for card in set(hand):
+            at_least[card_name(card)] += ways
+        if all(card == EXHAUSTION for card in hand):
+            exhaustion_only += ways
+    return {"hands": [[[card_name(c) for c in hand], ways / total] for hand, ways in hands[:TOP_HANDS]],
+            "best": {value: ways / total for value, ways in sorted(best.items(), key=lambda x: -x[1])},
+            "at_least": {name: ways / total for name, ways in sorted(at_least.items())},
+            "reshuffle": float(reshuffle),
+            "exhaustion_only": exhaustion_only / total}
+
+def exact_stage(stage):
+    """Exact odds of the next draw for every unfinished Rider in the Stage."""
+    odds = {}
+    for (team_name, short), rider in stage.riders().items():
+        if not rider.finished_stage:
+            odds.setdefault(team_name, {})[short] = {"name": rider.name, "short": short,
+                                                     **draw_odds(*next_draw(rider))}
+    return odds
+
+def output_exact_odds(stage):
+    """Outputs the exact odds of the next draw for every unfinished Rider."""
+    display_string = stage.formatter().heading("Next Draw Odds") + "\n"
+    for team_name, team_odds in exact_stage(stage).items():
+        for short, result in sorted(team_odds.items()):
+            best = list(result["best"].items())[:3]
+            parts = ["best " + ", ".join("{0} {1:.0%}".format(v, p) for v, p in best)]
+            if result["reshuffle"]:
+                parts.append("reshuffle")
+            if result["exhaustion_only"] > 0:
+                parts.append("{0} only {1:.0%}".format(card_name(EXHAUSTION), result["exhaustion_only"]))
+            display_string += "{0} {1}: {2}\n".format(team_name, result["name"], " | ".join(parts))
+    return display_string + "\n"
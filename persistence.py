@@ -0,0 +1,110 @@
+import atexit
+import logging
+import threading
+from collections import deque
+
+# Write-behind persistence
+# ========================
+# Stored states are written by a single background thread, so requests
+# don't wait on the disk. Writes happen in the order they were submitted.
+# A write with a coalesce key replaces the write queued just before it if
+# that has the same key and hasn't started, eg. the same state file being
+# rewritten by several actions in a row. A durable write waits until it,
+# and so everything before it, is on disk.
+#
+# Writes must not read the Stage: capture whatever they store when they are
+# submitted.
+
+# Determines how many writes can be queued before requests wait for the disk
+MAX_PENDING = 256
+
+logger = logging.getLogger(__name__)
+
+class _Write:
+    __slots__ = ("write", "key", "done", "error")
+
+    def __init__(self, write, key):
+        self.write = write
+        self.key = key
+        self.done = threading.Event()
+        self.error = None
+
+class PersistenceWorker:
+    def __init__(self, max_pending=MAX_PENDING, enabled=True):
+        self.max_pending = max_pending
+        # When disabled every write happens in the caller's thread
+        self.enabled = enabled
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._busy = False
+        self._thread = None
+        self._stopping = False
+        atexit.register(self.stop)
+
+    def submit(self, write, key=None, durable=False):
+        """Queue write() to run in the background.
+
+        If durable is set, wait for it to finish and raise any error."""
+        if not self.enabled:
+            write()
+            return
+        with self._condition:
+            self._start()
+            if (key is not None and len(self._pending) > 0
+                    and self._pending[-1].key == key):
+                # The queued write is out of date before it's been made
+                item = self._pending[-1]
+                item.write = write
+            else:
+                while len(self._pending) >= self.max_pending:
+                    self._condition.wait()
+                item = _Write(write, key)
+                self._pending.append(item)
+                self._condition.notify_all()
+        if durable:
+            item.done.wait()
+            if item.error is not None:
+                raise item.error
+
+    def flush(self):
+        """Wait until every queued write has been made."""
+        with self._condition:
+            while len(self._pending) > 0 or self._busy:
+                self._condition.wait()
+
+    def stop(self):
+        """Flush every queued write and stop the worker thread."""
+        self.flush()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopping = False
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._stopping:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                item = self._pending.popleft()
+                self._busy = True
+                self._condition.notify_all()
+            try:
+                item.write()
+            except Exception as e:
+                item.error = e
+                logger.exception("Failed to store %s", item.key or "state")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+                item.done.set()
@@ -0,0 +1,153 @@
+import queue
+import secrets
+import threading
+from collections import OrderedDict
+
+# Determines how many Stages are kept in memory at once
+MAX_STAGES = 16
+
+# Determines how many updates can wait for a slow client before it is dropped
+MAX_QUEUED_UPDATES = 64
+
+class Subscriber:
+    """A client watching a Stage, with the updates it hasn't been sent yet."""
+    def __init__(self, max_queued=MAX_QUEUED_UPDATES):
+        self.updates = queue.Queue(max_queued)
+        # Set when the client fell too far behind; it reconnects and catches up
+        self.dropped = False
+
+class StageSession:
+    """A Stage held in memory, along with the UI state that goes with it."""
+    def __init__(self, stage):
+        self.stage = stage
+        # Sent with versions, which start again whenever a Stage is loaded
+        self.id = secrets.token_hex(6)
+        self.phase_text = ""
+        self.last_exhaustion = []
+        # Actions displayed to clients, to detect when they change
+        self.action_flags = {}
+        # The Stage state and version Rider actions were last checked at
+        self.action_context = None
+        self.actions_version = 0
+        # Held for the duration of every request against this Stage
+        self.lock = threading.Lock()
+        # Clients watching the Stage, and the version they have been sent
+        self.subscribers = []
+        self.published_version = stage.version
+
+    def subscribe(self):
+        """Return a new Subscriber for updates published after this call."""
+        subscriber = Subscriber()
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, update, version):
+        """Queue an update, already rendered, for every Subscriber."""
+        self.published_version = version
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.updates.put_nowait(update)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def close(self):
+        """Drop every Subscriber, once the Stage is replaced or evicted.
+
+        Each is woken with None, so its client reconnects to the Stage now
+        held under the name."""
+        for subscriber in list(self.subscribers):
+            subscriber.dropped = True
+            try:
+                subscriber.updates.put_nowait(None)
+            except queue.Full:
+                # Stops once it has caught up, as it's been dropped
+                pass
+        self.subscribers = []
+
+class StageRegistry:
+    """Keeps the most recently used Stages in memory, keyed by name.
+
+    Every action is stored as it happens, so evicting a Stage only drops it
+    from memory; the provided load function brings it back from disk."""
+    def __init__(self, load, max_stages=MAX_STAGES):
+        self._load = load
+        self._sessions = OrderedDict()
+        # Only guards the dictionary, never held while loading or rendering
+        self._lock = threading.Lock()
+        self.max_stages = max_stages
+
+    def get(self, name):
+        """Return the session for the named Stage, loading it if required."""
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is not None:
+                self._sessions.move_to_end(name)
+                return session
+
+        stage = self._load(name)
+        if stage is None:
+            return None
+        with self._lock:
+            # Another request may have loaded it in the meantime
+            if name not in self._sessions:
+                self._insert(name, StageSession(stage))
+            self._sessions.move_to_end(name)
+            return self._sessions[name]
+
+    def acquire(self, name):
+        """Return the session for the named Stage with its lock held, or None.
+
+        Once locked the session can't be evicted, but it may have been while
+        waiting for the lock, so it's only returned if it's still held."""
+        while True:
+            session = self.get(name)
+            if session is None:
+                return None
+            session.lock.acquire()
+            with self._lock:
+                if self._sessions.get(name) is session:
+                    return session
+            session.lock.release()
+
+    def put(self, stage):
+        """Hold the provided Stage in memory, replacing any with its name.
+
+        The session is returned with its lock held, so no other request can
+        use it before the caller releases it."""
+        session = StageSession(stage)
+        session.lock.acquire()
+        with self._lock:
+            old_session = self._sessions.pop(stage.name, None)
+            self._insert(stage.name, session)
+        if old_session is not None:
+            old_session.close()
+        return session
+
+    def names(self):
+        """Return the names of all Stages in memory, most recent first."""
+        with self._lock:
+            return list(reversed(self._sessions.keys()))
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._sessions
+
+    def _insert(self, name, session):
+        self._sessions[name] = session
+        # Evict the least recently used Stages that aren't mid-request
+        for old_name in list(self._sessions.keys()):
+            if len(self._sessions) <= self.max_stages:
+                break
+            old_session = self._sessions[old_name]
+            if old_session is session or not old_session.lock.acquire(blocking=False):
+                continue
+            try:
+                del self._sessions[old_name]
+                old_session.close()
+            finally:
+                old_session.lock.release()
@@ -0,0 +1,260 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+from collections import Counter
+from flammerouge import *
+
+# Headless simulator
+# ==================
+# Plays complete stages with the real Stage, Team and Rider classes and no
+# host: a breakaway through perform_breakaway_energy_phase, turns through
+# perform_energy_phase and Team.play_s, and the next stage through
+# Stage.from_stage. Cards are chosen by a policy, see @policy below.
+#
+# There is no track here, so Riders are placed by the total value of the
+# cards they have played. A Rider with nobody on the space in front of it
+# takes an exhaustion card, and finishes once it has covered STAGE_LENGTH.
+#
+# Runs are spread over a process pool. Each run is seeded from the base seed
+# and its run number, and only its statistics come back to be aggregated, so
+# results don't depend on the number of workers.
+#
+#   python simulate.py --runs 10000 --policy best -o stats.json
+
+STAGE_LENGTH = 78
+STAGES = 3
+TEAMS = 4
+# Chance of each Team sending a Rider into the breakaway
+BREAKAWAY_CHANCE = 0.5
+# Stops a stage which can't finish, eg. a policy which only plays 2s
+MAX_TURNS = 60
+RUNS = 1000
+
+TEAM_NAMES = ("Red", "Blue", "Green", "Black", "White", "Pink")
+
+POLICIES = {}
+
+def policy(name):
+    """Register a card choice policy: policy(rider, rng) returns a drawn card."""
+    def register(f):
+        POLICIES[name] = f
+        return f
+    return register
+
+@policy("best")
+def play_best(rider, rng):
+    return max(rider.drawn_cards, key=card_value)
+
+@policy("lowest")
+def play_lowest(rider, rng):
+    return min(rider.drawn_cards, key=card_value)
+
+@policy("random")
+def play_random(rider, rng):
+    return rng.choice(list(rider.drawn_cards))
+
+@policy("exhaustion_first")
+def play_exhaustion_first(rider, rng):
+    # Clear exhaustion from the hand whenever possible
+    if EXHAUSTION in rider.drawn_cards:
+        return EXHAUSTION
+    return play_best(rider, rng)
+
+class Aggregate:
+    """Streaming summary of an integer statistic."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = Counter()
+
+    def add(self, value, times=1):
+        self.count += times
+        self.total += value * times
+        self.total_sq += value * value * times
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.histogram[value] += times
+
+    def merge(self, histogram):
+        for value, times in histogram.items():
+            self.add(value, times)
+
+    def to_dict(self):
+        mean = self.total / self.count if self.count else None
+        stdev = None
+        if self.count > 1:
+            stdev = math.sqrt(max(self.total_sq - self.total * mean, 0) / (self.count - 1))
+        return {"count": self.count, "mean": mean, "stdev": stdev,
+                "min": self.minimum, "max": self.maximum,
+                "histogram": {str(k): v for k, v in sorted(self.histogram.items())}}
+
+def _play(stage, riders, choose, rng):
+    # Play a card for each of the provided (team_name, short) through Team.play_s
+    plays = {}
+    for team_name, short in riders:
+        rider = stage.get_rider(team_name, short)
+        if len(rider.drawn_cards) > 0:
+            card = choose(rider, rng)
+            plays.setdefault(team_name, []).append("{0}{1}".format(short.lower(), card_name(card)))
+    for team_name, play in plays.items():
+        stage.get_team(team_name).play_s(" ".join(play))
+
+def _exhaustion(rider):
+    return sum(pile.count(EXHAUSTION) for pile in (rider.energy_pile, rider.recycle_pile,
+                                                   rider.drawn_cards, rider.discard_pile))
+
+def _last_value(rider, count=1):
+    return sum(card_value(c) for c in rider.get_last_cards_played()[:count])
+
+def simulate_breakaway(stage, choose, rng):
+    """Run a breakaway, returning the winner as (team_name, short) or None."""
+    entrants = []
+    for team_name, team in sorted(stage.team_dict.items()):
+        if rng.random() < BREAKAWAY_CHANCE:
+            short = rng.choice(sorted(team.riders.keys()))
+            stage.set_in_breakaway(team_name, short)
+            entrants.append((team_name, short))
+    if len(entrants) == 0:
+        return None
+    for bid in range(2):
+        stage.perform_breakaway_energy_phase()
+        _play(stage, entrants, choose, rng)
+    bids = [(_last_value(stage.get_rider(*entrant), 2), entrant) for entrant in entrants]
+    winner = max(bids, key=lambda bid: bid[0])[1]
+    for entrant in entrants:
+        if entrant == winner:
+            stage.set_breakaway_winner(*entrant)
+        else:
+            stage.set_breakaway_loser(*entrant)
+    return winner
+
+def simulate_stage(stage, choose, rng, stats, length=STAGE_LENGTH):
+    """Play the Stage until every Rider has finished, adding to stats."""
+    riders = [(team_name, short) for team_name, team in sorted(stage.team_dict.items())
+              for short in sorted(team.riders.keys())]
+    exhaustion = {r: _exhaustion(stage.get_rider(*r)) for r in riders}
+
+    simulate_breakaway(stage, choose, rng)
+    distance = dict.fromkeys(riders, 0)
+    reshuffles = dict.fromkeys(riders, 0)
+    empty_deck = {}
+    turn = 0
+    while stage.are_unfinished_riders() and turn < MAX_TURNS:
+        turn += 1
+        stage.perform_energy_phase()
+        racing = [r for r in riders if not stage.get_rider(*r).finished_stage]
+        for r in racing:
+            message = stage.get_rider(*r).message
+            if message == SHUFFLED_MESSAGE:
+                reshuffles[r] += 1
+            elif message and r not in empty_deck:
+                empty_deck[r] = turn
+        _play(stage, racing, choose, rng)
+
+        for r in racing:
+            distance[r] += _last_value(stage.get_rider(*r))
+        occupied = set(distance[r] for r in racing)
+        for r in racing:
+            if distance[r] + 1 not in occupied:
+                stage.add_exhaustion(*r)
+        for r in racing:
+            if distance[r] >= length:
+                stage.set_finished(*r)
+
+    stats["turns"][turn] += 1
+    for r in riders:
+        stats["exhaustion_gained"][_exhaustion(stage.get_rider(*r)) - exhaustion[r]] += 1
+        stats["reshuffles"][reshuffles[r]] += 1
+        if r in empty_deck:
+            stats["turns_to_empty_deck"][empty_deck[r]] += 1
+
+def simulate_run(run, seed, policy_name=None, stages=STAGES, teams=TEAMS, length=STAGE_LENGTH):
+    """Simulate a sequence of stages, returning histograms of each statistic."""
+    # Each Stage shuffles its decks from its own seed; the random module is
+    # used by the policies, so it's seeded for each run too
+    random.seed("{0}:{1}".format(seed, run))
+    choose = POLICIES[policy_name or "best"]
+    stats = {name: Counter() for name in ("turns", "exhaustion_gained", "exhaustion_carried",
+                                          "reshuffles", "turns_to_empty_deck")}
+
+    stage = Stage("Stage 1", seed=hash((seed, run, 0)))
+    for i in range(teams):
+        stage.add_team(TEAM_NAMES[i % len(TEAM_NAMES)] + ("" if i < len(TEAM_NAMES) else str(i)),
+                       "Player {0}".format(i + 1), "#000000")
+    for number in range(stages):
+        if number > 0:
+            next_stage = Stage("Stage {0}".format(number + 1), seed=hash((seed, run, number)))
+            next_stage.from_stage(stage)
+            stage = next_stage
+            for team in stage.team_dict.values():
+                for rider in team.riders.values():
+                    stats["exhaustion_carried"][rider.energy_pile.count(EXHAUSTION)] += 1
+        simulate_stage(stage, choose, random, stats, length)
+    return stats
+
+def _simulate_run(args):
+    return simulate_run(*args)
+
+def simulate(runs=RUNS, seed=0, policy_name="best", stages=STAGES, teams=TEAMS,
+             length=STAGE_LENGTH, workers=None, progress=None):
+    """Simulate many runs over a process pool, returning aggregated statistics."""
+    if policy_name not in POLICIES:
+        raise ValueError("Unknown policy '{0}'".format(policy_name))
+    tasks = ((run, seed, policy_name, stages, teams, length) for run in range(runs))
+    aggregates = {}
+
+    def add(stats, done):
+        for name, histogram in stats.items():
+            aggregates.setdefault(name, Aggregate()).merge(histogram)
+        if progress is not None:
+            progress(done, aggregates)
+
+    if workers == 1:
+        for done, task in enumerate(tasks, 1):
+            add(_simulate_run(task), done)
+    else:
+        workers = workers or os.cpu_count()
+        chunksize = max(1, min(64, runs // (workers * 8)))
+        with multiprocessing.Pool(workers) as pool:
+            for done, stats in enumerate(pool.imap_unordered(_simulate_run, tasks, chunksize), 1):
+                add(stats, done)
+    return {name: aggregate.to_dict() for name, aggregate in sorted(aggregates.items())}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate Flamme Rouge stages headlessly")
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--policy", choices=sorted(POLICIES.keys()), default="best")
+    parser.add_argument("--stages", type=int, default=STAGES, help="stages per run")
+    parser.add_argument("--teams", type=int, default=TEAMS)
+    parser.add_argument("--length", type=int, default=STAGE_LENGTH, help="spaces per stage")
+    parser.add_argument("--workers", type=int, help="processes to use, all cores by default")
+    parser.add_argument("-o", "--output", help="write statistics to this JSON file")
+    args = parser.parse_args()
+
+    def progress(done, aggregates):
+        if done % max(1, args.runs // 10) == 0 or done == args.runs:
+            turns = aggregates["turns"]
+            sys.stderr.write("{0}/{1} runs, {2:.1f} turns per stage\n".format(
+                done, args.runs, turns.total / turns.count))
+
+    stats = simulate(args.runs, args.seed, args.policy, args.stages, args.teams,
+                     args.length, args.workers, progress)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=2)
+    else:
+        for name, summary in stats.items():
+            if summary["count"] == 0:
+                continue
+            print("{0:<20} mean {1:>7.2f}  min {2:>4}  max {3:>4}".format(
+                name, summary["mean"] or 0, summary["min"], summary["max"]))
@@ -0,0 +1,190 @@
+import json
+import os
+import pickle
+import sys
+from flammerouge import DEFAULT_FORMAT, Rider, Stage, StageRandom, Team, card_names
+
+# Stage file format
+# =================
+# A stored Stage is a UTF-8 JSON-lines file. The first line is a small header
+# that describes the Stage without its decks, so listings only read one line:
+#
+#   {"format": "flammerouge-stage", "version": 1, "name": "Stage 1",
+#    "turn_number": 3, "bid_number": 0, "breakaway_started": true,
+#    "post_format": "discourse", "seed": 8731, "shuffles": 12,
+#    "track": "flat", "resolved_turn": 2,
+#    "teams": [{"name": "Red", "player": "Tom", "colour": "#ff0000", "bot": false,
+#               "riders": [["R", "Rouleur"], ["S", "Sprinteur"]]}]}
+#
+# Every following line is one Rider, in the order given by the header:
+#
+#   {"team": "Red", "short": "R", "energy_pile": ["3", "e2"],
+#    "recycle_pile": [], "discard_pile": ["5"], "drawn_cards": [],
+#    "message": "", "in_breakaway": false, "finished_stage": false,
+#    "position": [12, 0]}
+#
+# position is only present for Riders on the Stage's track.
+#
+# seed and shuffles restore the Stage's random stream, so later shuffles are
+# the same as they would have been had the Stage never been stored.
+# Cards are stored by name, so files don't depend on how cards are held in
+# memory. Readers reject files with a newer version than they understand.
+# Files written by older releases are pickles, which are still loaded and can
+# be converted with:
+#
+#   python stagefile.py <stages directory or file>...
+
+FORMAT_NAME = "flammerouge-stage"
+FORMAT_VERSION = 1
+
+_PILES = ("energy_pile", "recycle_pile", "discard_pile", "drawn_cards")
+_PICKLE_PROTOCOL_MARK = b"\x80"
+
+def is_pickle(filename):
+    """Return whether the file is a Stage stored by an older release."""
+    with open(filename, 'rb') as f:
+        return f.read(1) == _PICKLE_PROTOCOL_MARK
+
+def _check_header(header, filename):
+    if not isinstance(header, dict) or header.get("format") != FORMAT_NAME:
+        raise ValueError("{0} is not a stage file".format(filename))
+    if header["version"] > FORMAT_VERSION:
+        raise ValueError("{0} uses stage file version {1}, newer than {2}".format(
+            filename, header["version"], FORMAT_VERSION))
+
+def _stage_header(stage):
+    return {"format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "name": stage.name,
+            "turn_number": stage.turn_number,
+            "bid_number": stage.bid_number,
+            "breakaway_started": stage.breakaway_started,
+            "post_format": stage.format,
+            "seed": stage.rng.seed,
+            "shuffles": stage.rng.shuffles,
+            "track": stage.track,
+            "resolved_turn": stage.resolved_turn,
+            "teams": [{"name": team.name,
+                       "player": team.player,
+                       "colour": team.colour,
+                       "bot": team.bot,
+                       "riders": [[short, rider.name] for short, rider in team.riders.items()]}
+                      for team in stage.team_dict.values()]}
+
+def _pickle_header(stage):
+    # Pickled Stages have to be loaded in full to describe them
+    header = _stage_header(stage)
+    header["version"] = 0
+    return header
+
+def read_header(filename):
+    """Return the header of a stored Stage, without reading any decks."""
+    if is_pickle(filename):
+        with open(filename, 'rb') as f:
+            return _pickle_header(pickle.load(f))
+    with open(filename, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+    _check_header(header, filename)
+    return header
+
+def load_stage(filename):
+    """Load a stored Stage, in either format."""
+    if is_pickle(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    with open(filename, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        _check_header(header, filename)
+        riders = {}
+        positions = {}
+        for line in f:
+            if line.strip():
+                state = json.loads(line)
+                key = (state.pop("team"), state.pop("short"))
+                if "position" in state:
+                    positions[key] = tuple(state.pop("position"))
+                riders[key] = state
+
+    team_dict = {}
+    for team_header in header["teams"]:
+        team = Team.__new__(Team)
+        rider_dict = {}
+        for short, name in team_header["riders"]:
+            state = riders[(team_header["name"], short)]
+            rider = Rider.__new__(Rider)
+            rider.__setstate__({"name": name,
+                                "short_name": short,
+                                "_in_breakaway": state.pop("in_breakaway"),
+                                "_finished_stage": state.pop("finished_stage"),
+                                **state})
+            rider_dict[short] = rider
+        team.__setstate__({"name": team_header["name"],
+                           "player": team_header["player"],
+                           "colour": team_header["colour"],
+                           "bot": team_header.get("bot", False),
+                           "riders": rider_dict})
+        team_dict[team.name] = team
+
+    stage = Stage.__new__(Stage)
+    stage.__setstate__({"name": header["name"],
+                        "team_dict": team_dict,
+                        "turn_number": header["turn_number"],
+                        "bid_number": header["bid_number"],
+                        "breakaway_started": header["breakaway_started"],
+                        "format": header.get("post_format", DEFAULT_FORMAT),
+                        "rng": StageRandom(header.get("seed"), header.get("shuffles", 0)),
+                        "track": header.get("track"),
+                        "positions": positions,
+                        "resolved_turn": header.get("resolved_turn", 0)})
+    return stage
+
+def dumps_stage(stage):
+    """Return a Stage in the current format, as the text of a file."""
+    lines = [_stage_header(stage)]
+    for team in stage.team_dict.values():
+        for short, rider in team.riders.items():
+            state = {"team": team.name, "short": short}
+            for name in _PILES:
+                state[name] = card_names(getattr(rider, name))
+            state["message"] = rider.message
+            state["in_breakaway"] = rider.in_breakaway
+            state["finished_stage"] = rider.finished_stage
+            if (team.name, short) in stage.positions:
+                state["position"] = list(stage.positions[(team.name, short)])
+            lines.append(state)
+    return "".join(json.dumps(line, separators=(',', ':')) + "\n" for line in lines)
+
+def write_stage_text(filename, text):
+    """Write a Stage returned by dumps_stage."""
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def store_stage(filename, stage):
+    """Store a Stage in the current format."""
+    write_stage_text(filename, dumps_stage(stage))
+
+def convert_file(filename):
+    """Convert a pickled Stage file in place, returning whether it changed."""
+    if not is_pickle(filename):
+        return False
+    stage = load_stage(filename)
+    temp_filename = filename + ".tmp"
+    store_stage(temp_filename, stage)
+    os.replace(temp_filename, filename)
+    return True
+
+def convert(path, extensions=(".stage", ".snap")):
+    """Convert every pickled Stage file at or below the provided path."""
+    if os.path.isfile(path):
+        return [path] if convert_file(path) else []
+    converted = []
+    for root, dirs, files in os.walk(path):
+        for file in sorted(files):
+            if file.endswith(extensions):
+                converted += convert(os.path.join(root, file))
+    return converted
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        for filename in convert(path):
+            print("Converted {0}".format(filename))
@@ -0,0 +1,181 @@
+import json
+import os
+import sys
+from flammerouge import Stage
+from stagefile import load_stage, store_stage, write_stage_text
+
+# Per-stage action log
+# ====================
+# Every host action is appended to <stage>/actions.log as one JSON array:
+#
+#   ["3_movement", "play", "Red", "R", "4"]
+#   [label,        action, args...]
+#
+# Phases are actions too ("energy", "breakaway_energy"). Every shuffle comes
+# from the Stage's seeded random stream, so replaying the actions in order
+# reproduces every deck exactly. A new Stage is recorded with its seed:
+#
+#   ["created", "create", {"name": "Stage 1", "seed": 8731, "format": "discourse",
+#                          "track": "flat", "teams": [["Red", "Tom", "#CD4C32", "RS", false]]}]
+#
+# Stages created from another Stage, and states loaded from history, start
+# from a full snapshot instead. Every phase is followed by a snapshot too, so
+# rebuilding a state never replays more than one phase of actions:
+#
+#   ["3_energy", "energy"]
+#   ["3_energy", "snapshot", "00012-3_energy.snap"]
+#
+# A state is rebuilt from the nearest create or snapshot record before the
+# last record with the requested label, replaying the records in between.
+
+LOG_FILENAME = "actions.log"
+SNAPSHOT_EXTENSION = ".snap"
+
+def describe_stage(stage):
+    """Return the create record for a new Stage."""
+    return {"name": stage.name,
+            "seed": stage.rng.seed,
+            "format": stage.format,
+            "track": stage.track,
+            "teams": [[team.name, team.player, team.colour, "".join(team.riders.keys()), team.bot]
+                      for team in stage.team_dict.values()]}
+
+def create_stage(description):
+    """Create the Stage described by a create record."""
+    stage = Stage(description["name"], description["seed"])
+    stage.format = description["format"]
+    if description.get("track"):
+        stage.set_track(description["track"])
+    for team in description["teams"]:
+        stage.add_team(*team)
+    return stage
+
+def apply_action(stage, action, args):
+    """Apply a logged action to the provided Stage."""
+    if action == "play":
+        stage.play_card(*args)
+    elif action == "play_turn":
+        stage.play_moves(*args)
+    elif action == "exhaustion":
+        stage.add_exhaustion(*args)
+    elif action == "finished":
+        stage.set_finished(*args)
+    elif action == "in_breakaway":
+        stage.set_in_breakaway(*args)
+    elif action == "place_riders":
+        stage.place_riders(*args)
+    elif action == "resolve":
+        stage.resolve_movement()
+    elif action == "undo":
+        stage.undo()
+    elif action == "redo":
+        stage.redo()
+    elif action == "start_breakaway":
+        stage.start_breakaway()
+    elif action == "breakaway_energy":
+        stage.perform_breakaway_energy_phase()
+    elif action == "energy":
+        stage.perform_energy_phase()
+    elif action in ("winner", "loser"):
+        team_name, short = args
+        if action == "winner":
+            stage.set_breakaway_winner(team_name, short)
+        else:
+            stage.set_breakaway_loser(team_name, short)
+    else:
+        raise ValueError("Unknown action '{0}'".format(action))
+
+class StageLog:
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, LOG_FILENAME)
+        self._length = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(1 for record in self.records())
+        return self._length
+
+    def records(self):
+        """Yield each record in the log, oldest first."""
+        if not self.exists():
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def append(self, label, action, *args):
+        """Append a single action record to the log."""
+        line = json.dumps([label, action] + list(args), separators=(',', ':')) + "\n"
+        with open(self.path, 'a') as f:
+            f.write(line)
+        if self._length is not None:
+            self._length += 1
+        return len(line)
+
+    def snapshot(self, label, stage):
+        """Store a full snapshot of the Stage and record it in the log.
+
+        The Stage may also be given as the text from dumps_stage."""
+        filename = "{0:05d}-{1}{2}".format(len(self), label, SNAPSHOT_EXTENSION)
+        path = os.path.join(self.directory, filename)
+        if isinstance(stage, str):
+            write_stage_text(path, stage)
+        else:
+            store_stage(path, stage)
+        self.append(label, "snapshot", filename)
+        return filename
+
+    def labels(self):
+        """Return all labels in the log, most recent first."""
+        labels = []
+        for record in self.records():
+            if record[0] in labels:
+                labels.remove(record[0])
+            labels.append(record[0])
+        return list(reversed(labels))
+
+    def create(self, label, stage):
+        """Record a new Stage, which is rebuilt from its seed."""
+        self.append(label, "create", describe_stage(stage))
+
+    def load(self, label=None):
+        """Rebuild the Stage at the last record with the provided label.
+
+        If no label is provided the latest state is returned."""
+        records = list(self.records())
+        target = len(records) - 1
+        if label is not None:
+            while target >= 0 and records[target][0] != label:
+                target -= 1
+        if target < 0:
+            return None
+        return self.replay(records[:target+1])
+
+    def replay(self, records):
+        """Rebuild the Stage at the end of the provided records."""
+        start = len(records) - 1
+        while start >= 0 and records[start][1] not in ("create", "snapshot"):
+            start -= 1
+        if start < 0:
+            raise ValueError("No create or snapshot record found in {0}".format(self.path))
+
+        if records[start][1] == "create":
+            stage = create_stage(records[start][2])
+        else:
+            stage = load_stage(os.path.join(self.directory, records[start][2]))
+        for record in records[start+1:]:
+            apply_action(stage, record[1], record[2:])
+        return stage
+
+if __name__ == "__main__":
+    # Replay a Stage to verify a state: python stagelog.py <stage directory> [label]
+    log = StageLog(sys.argv[1])
+    stage = log.load(sys.argv[2] if len(sys.argv) > 2 else None)
+    if stage is None:
+        sys.exit("No state with that label")
+    print(stage)
@@ -1,10 +1,16 @@
+import os
+import tempfile
 from flammerouge import *
+from stagefile import dumps_stage
+from stagelog import StageLog, apply_action
+from export import stage_states
+from track import ASCENT_MAX, DESCENT_MIN, Track, resolve_turn
 
 def test_stage():
 	# Stage Setup
 	stage = Stage("Stage #1")
-	stage.add_team("Alice (Red)",  "#FF0000")
-	stage.add_team("Bob (Blue)", "#0000FF")
+	stage.add_team("Alice (Red)", "Alice", "#FF0000")
+	stage.add_team("Bob (Blue)", "Bob", "#0000FF")
 
 	alice = stage.get_team("Alice (Red)")
 	bob = stage.get_team("Bob (Blue)")
@@ -12,12 +18,12 @@ def test_stage():
 	print(stage)
 
 	# Breakaway Phase 1
-	stage.perform_breakaway_energy_phase()
-	print(stage.output_breakaway_energy_phase())
 	alice.riders["R"].in_breakaway = True
 	bob.riders["S"].in_breakaway = True
-	alice.play_s("r"+alice.riders["R"].drawn_cards[0])
-	bob.play_s("s"+bob.riders["S"].drawn_cards[0])
+	stage.perform_breakaway_energy_phase()
+	print(stage.output_breakaway_energy_phase())
+	alice.play_s("r"+card_name(alice.riders["R"].drawn_cards[0]))
+	bob.play_s("s"+card_name(bob.riders["S"].drawn_cards[0]))
 	print(stage.output_breakaway_bid_phase())
 
 	print(stage)
@@ -25,8 +31,8 @@ def test_stage():
 	# Breakaway Phase 2
 	stage.perform_breakaway_energy_phase()
 	print(stage.output_breakaway_energy_phase())
-	alice.play_s("r"+alice.riders["R"].drawn_cards[0])
-	bob.play_s("s"+bob.riders["S"].drawn_cards[0])
+	alice.play_s("r"+card_name(alice.riders["R"].drawn_cards[0]))
+	bob.play_s("s"+card_name(bob.riders["S"].drawn_cards[0]))
 	print(stage.output_breakaway_bid_phase())
 
 	print(stage)
@@ -47,8 +53,8 @@ def test_stage():
 	
 	print(stage.output_energy_phase())
 	
-	alice.play_s("r{0} s{1}".format(alice.riders["R"].drawn_cards[0],alice.riders["S"].drawn_cards[0]))
-	bob.play_s("r{0} s{1}".format(bob.riders["R"].drawn_cards[0],bob.riders["S"].drawn_cards[0]))
+	alice.play_s("r{0} s{1}".format(card_name(alice.riders["R"].drawn_cards[0]),card_name(alice.riders["S"].drawn_cards[0])))
+	bob.play_s("r{0} s{1}".format(card_name(bob.riders["R"].drawn_cards[0]),card_name(bob.riders["S"].drawn_cards[0])))
 	alice.add_s("r")
 	
 	print(stage.output_movement_phase())
@@ -59,3 +65,126 @@ def test_stage():
 	stage2.from_stage(stage)
 	
 	print(stage2)
+
+def test_track():
+	track = Track("test", "s5 f5 a5 f5 d5 f10 F5")
+	print(track.start, track.finish, len(track))
+
+	# Blocked by a full square, ending on the square behind it
+	resolution = resolve_turn(track, {"A": (7, 0), "B": (7, 1), "C": (5, 0)}, {"C": 2})
+	print(resolution)
+	assert resolution.before["C"] == (6, 0)
+
+	# Slipstream across a one square gap; the group that moves up joins the
+	# group in front, which then moves up too
+	resolution = resolve_turn(track, {"A": (9, 0), "B": (7, 0), "C": (5, 0)}, {})
+	print(resolution)
+	assert resolution.after == {"A": (9, 0), "B": (8, 0), "C": (7, 0)}
+
+	# No slipstream into a gap of two squares
+	resolution = resolve_turn(track, {"A": (9, 0), "B": (6, 0)}, {})
+	assert resolution.after == {"A": (9, 0), "B": (6, 0)}
+
+	# Ascents cap the move, descents give a minimum
+	print(track.movement(6, 9), track.movement(20, 2), track.movement(25, 2))
+	assert track.movement(6, 9) == ASCENT_MAX
+	assert track.movement(20, 2) == DESCENT_MIN
+	assert track.movement(25, 2) == 2
+
+	# Only the front Rider of a group takes exhaustion
+	resolution = resolve_turn(track, {"A": (5, 0), "B": (5, 1)}, {"A": 3, "B": 2})
+	print(resolution)
+	assert resolution.exhausted == ["A"]
+
+def test_replay():
+	# A Stage rebuilt from its log matches the one that was played
+	log = StageLog(tempfile.mkdtemp())
+	stage = Stage("Stage #1", seed=1234)
+	stage.add_team("Alice (Red)", "Alice", "#FF0000")
+	stage.add_team("Bob (Blue)", "Bob", "#0000FF")
+	log.create("created", stage)
+
+	def act(label, action, *args):
+		apply_action(stage, action, args)
+		log.append(label, action, *args)
+
+	act("breakaway", "start_breakaway")
+	act("breakaway", "in_breakaway", "Alice (Red)", "R")
+	act("breakaway", "in_breakaway", "Bob (Blue)", "S")
+	for bid in range(2):
+		act("bid", "breakaway_energy")
+		for team_name, short in (("Alice (Red)", "R"), ("Bob (Blue)", "S")):
+			act("bid", "play", team_name, short, card_name(stage.get_rider(team_name, short).drawn_cards[0]))
+	act("breakaway", "winner", "Alice (Red)", "R")
+	act("breakaway", "loser", "Bob (Blue)", "S")
+	for turn in range(8):
+		act("{0}_energy".format(turn), "energy")
+		for (team_name, short), rider in sorted(stage.riders().items()):
+			if rider.drawn_cards:
+				act("{0}_movement".format(turn), "play", team_name, short, card_name(rider.drawn_cards[0]))
+		act("{0}_movement".format(turn), "exhaustion", "Bob (Blue)", "R")
+
+	print(stage)
+	assert dumps_stage(log.load()) == dumps_stage(stage)
+
+def test_load_undo():
+	# Undoing straight after loading a state survives the Stage being evicted
+	import index
+	index.PERSISTENCE = index.Persistence.LOG
+	index.stages_dir = tempfile.mkdtemp() + "/"
+	client = index.app.test_client()
+	client.post("/create_stage", data={"stage_name": "Stage 3",
+	                                   "team_name_1": "Alice (Red)", "team_player_1": "Alice", "team_colour_1": "#FF0000",
+	                                   "team_name_2": "Bob (Blue)", "team_player_2": "Bob", "team_colour_2": "#0000FF"})
+	stage = lambda: index.stage_registry.get("Stage 3").stage
+	client.get("/stage/Stage 3/energy")
+	rider = stage().get_rider("Alice (Red)", "R")
+	client.get("/stage/Stage 3/play/Alice (Red)/R/" + card_name(rider.drawn_cards[0]))
+	client.post("/load_stage_state", data={"stage_name": "Stage 3", "stage_file": "1_movement.stage"})
+	client.get("/stage/Stage 3/undo")
+	index.persistence.flush()
+
+	live = dumps_stage(stage())
+	index.stage_registry._sessions.clear()
+	print(stage())
+	assert dumps_stage(stage()) == live
+
+def test_export():
+	# Reshuffles are counted once, even for Riders which have finished since
+	stages_dir = tempfile.mkdtemp()
+	log = StageLog(os.path.join(stages_dir, "Stage 4"))
+	os.makedirs(log.directory)
+	stage = Stage("Stage 4", seed=99)
+	stage.add_team("Alice (Red)", "Alice", "#FF0000")
+	stage.add_team("Bob (Blue)", "Bob", "#0000FF")
+	log.create("created", stage)
+
+	def act(label, action, *args):
+		apply_action(stage, action, args)
+		log.append(label, action, *args)
+
+	reshuffles, finished = {}, None
+	for turn in range(12):
+		act("{0}_energy".format(turn), "energy")
+		for key, rider in stage.riders().items():
+			if not rider.finished_stage and rider.message == SHUFFLED_MESSAGE:
+				reshuffles[key] = reshuffles.get(key, 0) + 1
+		for (team_name, short), rider in sorted(stage.riders().items()):
+			if rider.drawn_cards:
+				act("{0}_movement".format(turn), "play", team_name, short, card_name(rider.drawn_cards[0]))
+		if finished is None and reshuffles:
+			finished = sorted(reshuffles)[0]
+			act("{0}_end".format(turn), "finished", *finished)
+
+	for name, label, state, tally in stage_states(stages_dir, {}):
+		pass
+	print(finished, reshuffles, tally.reshuffles)
+	assert finished is not None
+	assert tally.reshuffles == reshuffles
+
+if __name__ == "__main__":
+	test_stage()
+	test_track()
+	test_replay()
+	test_load_undo()
+	test_export()
@@ -0,0 +1,192 @@
+import re
+from collections import namedtuple
+
+# Track and movement
+# ==================
+# A track is a line of squares, each one or more lanes wide. Riders are
+# placed on (square, lane), lane 0 being the right hand lane. Tracks are
+# written as segments of a kind and a number of squares, optionally with the
+# number of lanes (2 by default):
+#
+#   "s5 f20 a6x1 d4 f35 F5"
+#
+#   s - start area, behind the start line
+#   f - flat
+#   a - ascent: a Rider starting on, or moving into, an ascent moves at most
+#       ASCENT_MAX, and neither gives nor takes slipstream there
+#   d - descent: a Rider starting on a descent moves at least DESCENT_MIN
+#   F - beyond the finish line; a Rider reaching it has finished the Stage
+#
+# resolve_turn plays out a movement phase: every Rider moves by the card it
+# played, leading Rider first, stopping behind any square that's full; then
+# groups move up a square into a one square gap, from the back; then every
+# Rider with an empty square in front of it takes an exhaustion card.
+
+START = "s"
+FLAT = "f"
+ASCENT = "a"
+DESCENT = "d"
+FINISH = "F"
+
+ASCENT_MAX = 5
+DESCENT_MIN = 5
+LANES = 2
+
+# Track layouts by name
+TRACKS = {
+    "flat": "s5 f68 F5",
+    "hills": "s5 f18 a4 d4 f16 a5 d3 f18 F5",
+    "mountain": "s5 f30 a12 d5 f21 F5",
+    "cobbles": "s5 f20 f8x1 f25 f5x1 f10 F5",
+    }
+
+_SEGMENT = re.compile(r"^(?P<kind>[sfadF])(?P<length>\d+)(?:x(?P<lanes>\d))?$")
+
+Square = namedtuple("Square", ("kind", "lanes"))
+Resolution = namedtuple("Resolution", ("before", "after", "exhausted", "finished"))
+
+class Track:
+    """The squares of a Stage, from the back of the start area."""
+    def __init__(self, name, layout):
+        self.name = name
+        self.layout = layout
+        self.squares = []
+        for segment in layout.split():
+            match = _SEGMENT.match(segment)
+            if match is None:
+                raise ValueError("Bad track segment '{0}'".format(segment))
+            lanes = int(match.group("lanes") or LANES)
+            self.squares += [Square(match.group("kind"), lanes)] * int(match.group("length"))
+        kinds = [square.kind for square in self.squares]
+        if START not in kinds or FINISH not in kinds:
+            raise ValueError("Track '{0}' needs a start area and a finish".format(name))
+        # The first square after the start line, and after the finish line
+        self.start = len(kinds) - kinds[::-1].index(START)
+        self.finish = kinds.index(FINISH)
+
+    def __len__(self):
+        return len(self.squares)
+
+    def kind(self, square):
+        return self.squares[square].kind
+
+    def lanes(self, square):
+        return self.squares[square].lanes
+
+    def movement(self, square, value):
+        """Return how far a card of the provided value moves a Rider from square."""
+        if self.kind(square) == DESCENT:
+            value = max(value, DESCENT_MIN)
+        last = min(square + value, len(self) - 1)
+        if any(self.kind(s) == ASCENT for s in range(square, last + 1)):
+            value = min(value, ASCENT_MAX)
+        return value
+
+def get_track(name):
+    """Return the named Track."""
+    try:
+        return Track(name, TRACKS[name])
+    except KeyError:
+        raise ValueError("Unknown track '{0}'".format(name))
+
+def track_names():
+    return sorted(TRACKS.keys())
+
+def _occupancy(track, positions):
+    # Return {square: [key or None for each lane]}
+    occupied = {}
+    for key, (square, lane) in positions.items():
+        occupied.setdefault(square, [None] * track.lanes(square))[lane] = key
+    return occupied
+
+def start_positions(track, riders):
+    """Place the provided Riders on the start area, in order, from the start line back."""
+    positions = {}
+    square, lane = track.start - 1, 0
+    for key in riders:
+        if square < 0:
+            raise ValueError("Too many riders for the start area")
+        positions[key] = (square, lane)
+        lane += 1
+        if lane == track.lanes(square):
+            square, lane = square - 1, 0
+    return positions
+
+def _move(track, occupied, key, position, value):
+    # Move a Rider forward, ending on the furthest square with a free lane
+    square, lane = position
+    occupied[square][lane] = None
+    target = min(square + track.movement(square, value), len(track) - 1)
+    for s in range(target, square, -1):
+        lanes = occupied.setdefault(s, [None] * track.lanes(s))
+        if None in lanes:
+            free = lanes.index(None)
+            lanes[free] = key
+            return (s, free)
+    occupied[square][lane] = key
+    return position
+
+def _slipstream(track, occupied):
+    # Move each group into a gap of exactly one square in front of it,
+    # starting with the rearmost group. A group that moves up joins the
+    # group in front, which is checked next
+    squares = sorted(s for s, lanes in occupied.items() if any(lanes))
+    i = 0
+    while i < len(squares):
+        j = i
+        while j + 1 < len(squares) and squares[j + 1] == squares[j] + 1:
+            j += 1
+        front = squares[j]
+        group = squares[i:j + 1]
+        if (j + 1 < len(squares) and squares[j + 1] == front + 2
+                and not any(track.kind(s) == ASCENT for s in group + [front + 1, front + 2])
+                and all(sum(k is not None for k in occupied[s]) <= track.lanes(s + 1) for s in group)):
+            for s in reversed(group):
+                keys = [k for k in occupied[s] if k is not None]
+                occupied[s + 1] = keys + [None] * (track.lanes(s + 1) - len(keys))
+                occupied[s] = [None] * track.lanes(s)
+            squares[i:j + 1] = [s + 1 for s in group]
+            # Now part of the group in front
+            continue
+        i = j + 1
+
+def _positions(occupied):
+    return {key: (square, lane) for square, lanes in occupied.items()
+            for lane, key in enumerate(lanes) if key is not None}
+
+def resolve_turn(track, positions, moves):
+    """Resolve a movement phase.
+
+    positions maps each Rider's key to (square, lane) and moves maps the keys
+    of the Riders which moved to the value of their card. Returns a
+    Resolution of the positions before and after slipstream, the keys of the
+    Riders taking exhaustion and of those which finished, in track order."""
+    occupied = _occupancy(track, positions)
+    # Leading Rider first, right hand lane first
+    order = sorted(positions.items(), key=lambda item: (-item[1][0], item[1][1]))
+    for key, position in order:
+        if key in moves:
+            _move(track, occupied, key, position, moves[key])
+    before = _positions(occupied)
+
+    _slipstream(track, occupied)
+    after = _positions(occupied)
+
+    ordered = sorted(after.items(), key=lambda item: (-item[1][0], item[1][1]))
+    finished = [key for key, (square, lane) in ordered if square >= track.finish and key in moves]
+    exhausted = [key for key, (square, lane) in ordered
+                 if key in moves and square < track.finish
+                 and square + 1 < len(track) and not any(occupied.get(square + 1, ()))]
+    return Resolution(before, after, exhausted, finished)
+
+def position_lines(track, positions, names):
+    """Return a line for each occupied square, leading square first.
+
+    names maps each Rider's key to the text shown for it."""
+    occupied = _occupancy(track, positions)
+    lines = []
+    for square in sorted(occupied.keys(), reverse=True):
+        riders = ", ".join(names[key] for key in occupied[square] if key is not None)
+        lines.append("{0:>3}{1} {2}".format(square - track.start + 1,
+                                           track.kind(square) if track.kind(square) != FLAT else " ", riders))
+    return lines
@@ -0,0 +1,145 @@
+import hashlib
+import io
+import os
+import threading
+from functools import lru_cache
+from track import ASCENT, DESCENT, FINISH, START
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+# Position images
+# ===============
+# Pictures of the Riders on a track, for the movement phase posts. The track
+# is the expensive part and is the same every turn, so it is drawn once per
+# layout and kept in memory and on disk; each image then only adds a token
+# for every Rider. Images are PNG and need Pillow; without it the posts show
+# the positions as text instead, as forums don't take SVG images.
+#
+# The track is drawn left to right in rows of ROW_SQUARES squares, each
+# square a column of lanes with the right hand lane (lane 0) at the bottom.
+
+# Determines where drawn tracks are kept between runs
+CACHE_DIR = "./track_cache/"
+
+ROW_SQUARES = 26
+SQUARE_WIDTH = 36
+LANE_HEIGHT = 26
+ROW_GAP = 18
+MARGIN = 8
+TOKEN_MARGIN = 3
+
+SQUARE_COLOURS = {
+    START: "#B8B8B8",
+    ASCENT: "#E7A7A0",
+    DESCENT: "#9FC3E6",
+    FINISH: "#F2DE7A",
+    }
+FLAT_COLOUR = "#EDEDE4"
+LINE_COLOUR = "#606060"
+
+_backgrounds = {}
+_lock = threading.Lock()
+
+def image_format():
+    """Return the extension of the images drawn here, or None if they can't be drawn."""
+    return "png" if Image is not None else None
+
+def _max_lanes(track):
+    return max(square.lanes for square in track.squares)
+
+def _row_height(track):
+    return _max_lanes(track) * LANE_HEIGHT + ROW_GAP
+
+def _size(track):
+    rows = (len(track) + ROW_SQUARES - 1) // ROW_SQUARES
+    return (2 * MARGIN + min(len(track), ROW_SQUARES) * SQUARE_WIDTH,
+            2 * MARGIN + rows * _row_height(track))
+
+def _lane_box(track, square, lane):
+    # Return (left, top, right, bottom) of a lane of a square
+    row, column = divmod(square, ROW_SQUARES)
+    left = MARGIN + column * SQUARE_WIDTH
+    # Narrow squares are centred in the row
+    offset = (_max_lanes(track) - track.lanes(square)) * LANE_HEIGHT // 2
+    bottom = MARGIN + row * _row_height(track) + _max_lanes(track) * LANE_HEIGHT - offset
+    return (left, bottom - (lane + 1) * LANE_HEIGHT, left + SQUARE_WIDTH, bottom - lane * LANE_HEIGHT)
+
+@lru_cache(maxsize=256)
+def text_colour(colour):
+    """Return the font colour to use on the provided background colour."""
+    # Determine font colour from relative brightness
+    r, g, b = bytearray.fromhex(colour.lstrip('#'))
+    y = 0.2126 * pow((r/255),2.2) +  0.7151 * pow((g/255),2.2)  +  0.0721 * pow((b/255),2.2)
+    if y < 0.30:
+        return "white"
+    return "black"
+
+# PNG
+
+def _png_background(track):
+    image = Image.new("RGB", _size(track), "#FFFFFF")
+    draw = ImageDraw.Draw(image)
+    for square in range(len(track)):
+        colour = SQUARE_COLOURS.get(track.kind(square), FLAT_COLOUR)
+        for lane in range(track.lanes(square)):
+            draw.rectangle(_lane_box(track, square, lane), fill=colour, outline=LINE_COLOUR)
+        if square == track.start or square == track.finish:
+            left, top = _lane_box(track, square, track.lanes(square) - 1)[:2]
+            bottom = _lane_box(track, square, 0)[3]
+            draw.line((left, top, left, bottom), fill="#000000", width=3)
+        if square >= track.start and (square - track.start + 1) % 5 == 0:
+            left, top, right, bottom = _lane_box(track, square, 0)
+            draw.text((left + 2, bottom + 2), str(square - track.start + 1), fill="#000000")
+    return image
+
+def _png_image(background, track, positions, tokens):
+    image = background.copy()
+    draw = ImageDraw.Draw(image)
+    for key, (square, lane) in positions.items():
+        colour, label = tokens[key]
+        left, top, right, bottom = _lane_box(track, square, lane)
+        centre_x, centre_y = (left + right) // 2, (top + bottom) // 2
+        radius = LANE_HEIGHT // 2 - TOKEN_MARGIN
+        draw.ellipse((centre_x - radius, centre_y - radius, centre_x + radius, centre_y + radius),
+                     fill=colour, outline="#000000")
+        draw.text((centre_x - 3, centre_y - 6), label, fill=text_colour(colour))
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+# Cached background
+
+def _cache_path(track, cache_dir):
+    digest = hashlib.sha1(track.layout.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "{0}-{1}.{2}".format(track.name, digest, image_format()))
+
+def background(track, cache_dir=None):
+    """Return the drawn track, from memory, the cache directory or by drawing it."""
+    key = (track.layout, image_format())
+    with _lock:
+        if key in _backgrounds:
+            return _backgrounds[key]
+    cache_dir = cache_dir or CACHE_DIR
+    path = _cache_path(track, cache_dir)
+    if os.path.exists(path):
+        drawn = Image.open(path)
+        drawn.load()
+    else:
+        drawn = _png_background(track)
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = path + ".tmp"
+        drawn.save(temp_path, "PNG")
+        os.replace(temp_path, path)
+    with _lock:
+        _backgrounds[key] = drawn
+    return drawn
+
+def render_positions(track, positions, tokens, cache_dir=None):
+    """Return a PNG image of the Riders at the provided positions, as bytes.
+
+    positions maps each Rider's key to (square, lane) and tokens maps it to
+    (colour, label) for its token. Needs Pillow, see image_format."""
+    return _png_image(background(track, cache_dir), track, positions, tokens)